@@ -1,11 +1,8 @@
 #!/usr/bin/python -tu
 import os
 import sys
-import difflib
-import shutil
 import stat
-from datetime import datetime
-from optparse import OptionParser
+import threading
 
 class Chooser:
     def ask(self, prompt):
@@ -17,6 +14,7 @@ class Chooser:
 class Tracer:
     def __init__(self, out):
         self.tracing = 0
+        self.errors = 0
         self.out = out
 
     def report(self, str):
@@ -25,12 +23,39 @@ class Tracer:
             self.tracing = 0
         self.out.write(str + '\n')
 
+    def error(self, str):
+        self.errors += 1
+        self.report(str)
+
     def trace(self, str):
         str = str[0:79]
         fill = self.tracing - len(str)
         self.out.write('\r' + str + ''.join([' ' for i in range(fill)]) + ''.join(['\b' for i in range(fill)]))
         self.tracing = len(str)
 
+    def countdown(self, n):
+        self.out.write(str(n) + '\b')
+
+    def skip(self, subject, why):
+        self.report(subject + " skipped - " + why)
+
+    def compared(self, compair):
+        # Show size and time of both versions of a file
+        from datetime import datetime
+        master = compair.session.master
+        self.report("%10i %s %s" % (compair.statA[stat.ST_SIZE], datetime.fromtimestamp(compair.statA[stat.ST_MTIME]).ctime(), master.dirA))
+        self.report("%10i %s %s" % (compair.statB[stat.ST_SIZE], datetime.fromtimestamp(compair.statB[stat.ST_MTIME]).ctime(), master.dirB))
+
+    def classified(self, compair, action):
+        # action is None for directories in common
+        pass
+
+    def performed(self, compair, action, granted, done):
+        pass
+
+    def finish(self):
+        self.leave()
+
     def end(self, str = ''):
         if self.tracing:
             self.out.write(str + '\n')
@@ -41,11 +66,1156 @@ class Tracer:
             self.out.write('\r' + ''.join([' ' for i in range(self.tracing)]) + '\r')
             self.tracing = 0
 
+class EventTracer(Tracer):
+    # Writes one JSON object per line, to a binary stream, instead of text
+    # meant for a terminal: how each entry is classified, what's done about
+    # it, messages, progress every PROGRESS_NS and totals at the end.
+    PROGRESS_NS = 1000000000
+
+    def __init__(self, out):
+        import json
+        import time
+        Tracer.__init__(self, out)
+        self.encode = json.JSONEncoder(separators=(',', ':')).encode
+        self.clock = time.monotonic_ns
+        self.last_progress = self.clock()
+        self.entries = 0
+        self.done = {}
+
+    def event(self, **fields):
+        self.out.write(self.encode(fields).encode('ascii') + b'\n')
+
+    def progress(self):
+        now = self.clock()
+        if now - self.last_progress >= self.PROGRESS_NS:
+            self.last_progress = now
+            self.event(event="progress", entries=self.entries, errors=self.errors)
+
+    def report(self, str):
+        self.event(event="message", text=str)
+
+    def error(self, str):
+        self.errors += 1
+        self.event(event="error", text=str)
+
+    def trace(self, str):
+        self.progress()
+
+    def countdown(self, n):
+        pass
+
+    def skip(self, subject, why):
+        self.entries += 1
+        self.event(event="skip", path=subject, reason=why)
+        self.progress()
+
+    def compared(self, compair):
+        pass
+
+    def classified(self, compair, action):
+        self.entries += 1
+        fields = dict(event="entry", path=compair.subject)
+        if compair.session.master.label:
+            fields['target'] = compair.session.master.dirB
+        if action is None:
+            fields['class'] = "common directory"
+        else:
+            fields['class'] = action.reason
+            fields['treatment'] = action.treatment
+        for side, st in ('a', compair.statA), ('b', compair.statB):
+            if st is not None:
+                fields[side] = [st.st_mode, st.st_size, st.st_mtime_ns]
+        self.event(**fields)
+        self.progress()
+
+    def performed(self, compair, action, granted, done):
+        if action.isIgnore():
+            return
+        fields = dict(event="action", path=compair.subject, treatment=action.treatment, granted=bool(granted), done=bool(done))
+        if compair.session.master.label:
+            fields['target'] = compair.session.master.dirB
+        self.event(**fields)
+        if done:
+            self.done[action.treatment] = self.done.get(action.treatment, 0) + 1
+
+    def finish(self):
+        self.event(event="stats", entries=self.entries, errors=self.errors, done=self.done)
+        self.out.flush()
+
+    def end(self, str = ''):
+        self.report(str)
+
+    def leave(self):
+        pass
+
+class TimeModel:
+    # Decides whether two modification times are equal enough. Timestamps may
+    # lose precision on the way to a file system that stores them coarsely, and
+    # may appear shifted by whole hours because of time zones or daylight
+    # saving time (e.g. FAT storing local time). The granularity of a
+    # timestamp is judged from itself alone, so that it doesn't depend on
+    # what was compared before; FAT's 2 seconds only if fat is set, as any
+    # file system has timestamps on even seconds now and then.
+    GRANULARITIES_NS = (1000000000, 1000000, 1000, 100, 1)
+    FAT_GRANULARITY_NS = 2000000000
+
+    def __init__(self, tolerance_ns=1000000000, offsets_ns=(0, 3600000000000, 7200000000000), fat=False):
+        self.tolerance_ns = tolerance_ns
+        self.offsets_ns = offsets_ns
+        if fat:
+            self.granularities_ns = (self.FAT_GRANULARITY_NS,) + self.GRANULARITIES_NS
+        else:
+            self.granularities_ns = self.GRANULARITIES_NS
+
+    def getGranularity(self, st):
+        # Coarsest granularity that the timestamp complies with.
+        mtime_ns = st.st_mtime_ns
+        for granularity_ns in self.granularities_ns:
+            if not mtime_ns % granularity_ns:
+                return granularity_ns
+        return 1
+
+    def equal(self, statA, statB):
+        delta = abs(statB.st_mtime_ns - statA.st_mtime_ns)
+        slack = self.tolerance_ns + max(self.getGranularity(statA), self.getGranularity(statB))
+        for offset in self.offsets_ns:
+            if abs(delta - offset) < slack:
+                return True
+        return False
+
+def make_stat(mode, ino, dev, nlink, uid, gid, size, atime_ns, mtime_ns, ctime_ns):
+    # an os.stat_result from its fields, with times in nanoseconds
+    NS = 1000000000
+    return os.stat_result((mode, ino, dev, nlink, uid, gid, size, atime_ns // NS, mtime_ns // NS, ctime_ns // NS, atime_ns / NS, mtime_ns / NS, ctime_ns / NS, atime_ns, mtime_ns, ctime_ns))
+
+class DirSnapshot:
+    # Listings of directories and the lstat of their entries, from previous
+    # runs, reused as long as the directory's device, inode, modification and
+    # change time are the same, so that an unchanged directory costs a single
+    # stat. A file modified in place leaves its directory unchanged, and goes
+    # unnoticed until something else changes the directory: that's why a
+    # snapshot is optional. Directories changed less than MARGIN_NS before
+    # being listed aren't remembered, as they might change again within
+    # their timestamp's granularity, and neither are those in which anything
+    # was done. Once a tree is walked through, directories below it that
+    # weren't listed are dropped, so that those gone don't pile up. Jobs in
+    # one process share the snapshot of a file; processes sharing one
+    # overwrite each other's, the last one saved winning.
+    MARGIN_NS = 2000000000
+    VERSION = 2
+    lock = threading.Lock()
+    opened = {}
+
+    def __init__(self, path):
+        import json
+        self.path = path
+        try:
+            with open(path) as f:
+                snapshot = json.load(f)
+            assert snapshot['version'] == self.VERSION
+            self.entries = snapshot['directories']
+        except (EnvironmentError, ValueError, TypeError, KeyError, AssertionError):
+            self.entries = {}
+        self.changed = False
+        self.scanned = set()
+
+    @classmethod
+    def shared(cls, path):
+        key = os.path.abspath(path)
+        with cls.lock:
+            try:
+                return cls.opened[key]
+            except KeyError:
+                snapshot = cls.opened[key] = cls(path)
+                return snapshot
+
+    def scandir(self, path):
+        # returns a dict of the basenames in a directory and their lstat
+        import time
+        key = os.path.abspath(path)
+        with self.lock:
+            old = self.entries.pop(key, None)
+            self.scanned.add(key)
+        try:
+            st = os.stat(path)
+        except EnvironmentError:
+            st = None
+        if st is None or not stat.S_ISDIR(st.st_mode):
+            if old is not None:
+                with self.lock:
+                    self.changed = True
+            return {}
+        meta = [st.st_dev, st.st_ino, st.st_mtime_ns, st.st_ctime_ns]
+        if old is not None and old[0] == meta:
+            fields = old[1]
+            entries = dict((basename, f and make_stat(*f)) for basename, f in fields.items())
+        else:
+            fields = {}
+            entries = {}
+            for basename in os.listdir(path):
+                try:
+                    entries[basename] = stB = os.lstat(os.path.join(path, basename))
+                except EnvironmentError:
+                    entries[basename] = fields[basename] = None
+                else:
+                    fields[basename] = [stB.st_mode, stB.st_ino, stB.st_dev, stB.st_nlink, stB.st_uid, stB.st_gid, stB.st_size, stB.st_atime_ns, stB.st_mtime_ns, stB.st_ctime_ns]
+        remember = time.time_ns() - max(st.st_mtime_ns, st.st_ctime_ns) >= self.MARGIN_NS
+        with self.lock:
+            if remember:
+                self.entries[key] = [meta, fields]
+            if (old is not None) != remember or (remember and old[1] is not fields):
+                self.changed = True
+        return entries
+
+    def prune(self, path):
+        # drops the directories below path, a tree just walked through, that
+        # weren't listed in this process
+        root = os.path.abspath(path)
+        below = os.path.join(root, '')
+        with self.lock:
+            for key in [key for key in self.entries if (key == root or key.startswith(below)) and key not in self.scanned]:
+                del self.entries[key]
+                self.changed = True
+
+    def forget(self, path):
+        with self.lock:
+            if self.entries.pop(os.path.abspath(path), None) is not None:
+                self.changed = True
+
+    def save(self):
+        # through a file of its own, so that a snapshot is never found half
+        # written; not at all if nothing changed since it was loaded
+        import json
+        import tempfile
+        with self.lock:
+            if not self.changed:
+                return
+            self.changed = False
+            data = json.dumps({'version': self.VERSION, 'directories': self.entries}, separators=(',', ':'))
+        fd, temppath = tempfile.mkstemp(prefix=os.path.basename(self.path) + '.', suffix='.new', dir=os.path.dirname(os.path.abspath(self.path)))
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(data)
+            os.replace(temppath, self.path)
+        except BaseException:
+            os.unlink(temppath)
+            self.changed = True
+            raise
+
+class Storage:
+    # Access to a tree of files, by full paths, on the local file system.
+    # Subclasses keep trees elsewhere; those that aren't local don't get the
+    # shortcuts taken with paths and file descriptors. Failures raise
+    # EnvironmentError with the path as filename, except that stat returns
+    # None for a missing entry.
+    local = True
+
+    def __init__(self, snapshot=None):
+        self.snapshot = snapshot
+
+    def listdir(self, path):
+        if os.path.isdir(path):
+            return os.listdir(path)
+        else:
+            return []
+
+    def scandir(self, path, follow_link):
+        # returns a dict of the basenames in a directory and their stats, so
+        # that stores with a cost per request can list them in bulk
+        if self.snapshot is not None and not follow_link:
+            return self.snapshot.scandir(path)
+        return dict((basename, self.stat(os.path.join(path, basename), follow_link)) for basename in self.listdir(path))
+
+    def stat(self, path, follow_link):
+        try:
+            if follow_link:
+                return os.stat(path)
+            else:
+                return os.lstat(path)
+        except EnvironmentError:
+            return None
+
+    def open(self, path):
+        return open(path, 'rb')
+
+    def readlink(self, path):
+        return os.readlink(path)
+
+    def write(self, path, fileA, statA):
+        import shutil
+        with open(path, 'wb') as fileB:
+            shutil.copyfileobj(fileA, fileB, 0x100000)
+        self.set_times(path, statA)
+
+    def set_times(self, path, statA):
+        os.utime(path, ns=(statA.st_atime_ns, statA.st_mtime_ns))
+
+    def mkdir(self, path):
+        os.mkdir(path)
+
+    def symlink(self, link, path):
+        os.symlink(link, path)
+
+    def remove(self, path):
+        os.unlink(path)
+
+    def rmdir(self, path):
+        os.rmdir(path)
+
+    def close(self):
+        pass
+
+class SourceCache(Storage):
+    # Remembers listings and stats of the source, so that they're obtained
+    # only once when comparing against several destinations. They're kept
+    # for the whole run, which takes memory in proportion to the number of
+    # entries in the source.
+    def __init__(self, snapshot=None):
+        Storage.__init__(self, snapshot)
+        self.listings = {}
+        self.stats = {}
+
+    def listdir(self, path):
+        try:
+            return self.listings[path]
+        except KeyError:
+            basenames = self.listings[path] = Storage.listdir(self, path)
+            return basenames
+
+    def stat(self, path, follow_link):
+        try:
+            return self.stats[path, follow_link]
+        except KeyError:
+            st = self.stats[path, follow_link] = Storage.stat(self, path, follow_link)
+            return st
+
+def member_stat(member, ino, size=None):
+    # stat of a tar archive's member, as if it were on a file system of its own
+    if member.isdir():
+        mode = stat.S_IFDIR
+    elif member.issym():
+        mode = stat.S_IFLNK
+        size = len(member.linkname)
+    elif member.ischr():
+        mode = stat.S_IFCHR
+    elif member.isblk():
+        mode = stat.S_IFBLK
+    elif member.isfifo():
+        mode = stat.S_IFIFO
+    else:
+        mode = stat.S_IFREG
+    if size is None:
+        size = member.size
+    mtime_ns = int(round(member.mtime * 1000000000))
+    return make_stat(mode | member.mode & 0o7777, ino, 0, 1, member.uid, member.gid, size, mtime_ns, mtime_ns, mtime_ns)
+
+def directory_stat(ino):
+    # stat of a directory that an archive implies without a member of its own
+    import tarfile
+    member = tarfile.TarInfo()
+    member.type = tarfile.DIRTYPE
+    member.mode = 0o755
+    return member_stat(member, ino)
+
+def storage_error(code, path):
+    import errno
+    code = getattr(errno, code)
+    return OSError(code, os.strerror(code), path)
+
+class TarSource(Storage):
+    # A tar archive read as a source tree, its members addressed by paths
+    # below the path of the archive. Members are indexed when opening, so
+    # listings and stats come from memory; contents are extracted when read.
+    # Links inside the archive are not followed. Members are read in the
+    # order of the walk, not of the archive, which a compressed archive
+    # would decompress from its start at every step back: it's decompressed
+    # into a temporary file instead, once.
+    local = False
+
+    def __init__(self, path):
+        import tarfile
+        Storage.__init__(self)
+        self.path = path
+        self.spool = None
+        try:
+            self.archive = tarfile.open(path, 'r:')
+        except tarfile.ReadError:
+            self.archive = self.decompress(path)
+        self.members = {}
+        self.listings = {'': {}}
+        self.stats = {'': directory_stat(0)}
+        for member in self.archive.getmembers():
+            parts = [part for part in member.name.split('/') if part not in ('', '.')]
+            if not parts or '..' in parts:
+                continue
+            # directories only implied by the names of their members
+            for i in range(1, len(parts)):
+                name = '/'.join(parts[:i])
+                if name not in self.listings:
+                    self.listings['/'.join(parts[:i - 1])][parts[i - 1]] = None
+                    self.listings[name] = {}
+                    self.stats[name] = directory_stat(len(self.stats))
+            name = '/'.join(parts)
+            self.listings['/'.join(parts[:-1])][parts[-1]] = None
+            if member.isdir():
+                self.listings.setdefault(name, {})
+            size = None
+            if member.islnk():
+                target = self.members.get('/'.join(part for part in member.linkname.split('/') if part not in ('', '.')))
+                size = target and target.size
+            self.members[name] = member
+            self.stats[name] = member_stat(member, len(self.stats), size)
+
+    def decompress(self, path):
+        # returns the compressed archive opened from a decompressed copy in
+        # a temporary file, the spool
+        import shutil
+        import tarfile
+        import tempfile
+        self.spool = tempfile.TemporaryFile()
+        try:
+            with tarfile.open(path) as compressed:
+                compressed.fileobj.seek(0)
+                shutil.copyfileobj(compressed.fileobj, self.spool, 0x100000)
+            self.spool.seek(0)
+            return tarfile.open(fileobj=self.spool, mode='r:')
+        except BaseException:
+            self.spool.close()
+            raise
+
+    def name(self, path):
+        name = os.path.relpath(path, self.path)
+        return '' if name == '.' else name.replace(os.sep, '/')
+
+    def listdir(self, path):
+        return list(self.listings.get(self.name(path), ()))
+
+    def stat(self, path, follow_link):
+        return self.stats.get(self.name(path))
+
+    def open(self, path):
+        member = self.members.get(self.name(path))
+        if member is None:
+            raise storage_error('ENOENT', path)
+        fileA = self.archive.extractfile(member)
+        if fileA is None:
+            raise storage_error('EISDIR' if member.isdir() else 'EINVAL', path)
+        return fileA
+
+    def readlink(self, path):
+        member = self.members.get(self.name(path))
+        if member is None:
+            raise storage_error('ENOENT', path)
+        if not member.issym():
+            raise storage_error('EINVAL', path)
+        return member.linkname
+
+    def write(self, path, fileA, statA):
+        raise storage_error('EROFS', path)
+
+    def set_times(self, path, statA):
+        raise storage_error('EROFS', path)
+
+    def mkdir(self, path):
+        raise storage_error('EROFS', path)
+
+    def symlink(self, link, path):
+        raise storage_error('EROFS', path)
+
+    def remove(self, path):
+        raise storage_error('EROFS', path)
+
+    def rmdir(self, path):
+        raise storage_error('EROFS', path)
+
+    def close(self):
+        self.archive.close()
+        if self.spool is not None:
+            self.spool.close()
+
+class TarTarget(Storage):
+    # A new tar archive written as a target tree, its members addressed by
+    # paths below the path of the archive. It starts out empty and is
+    # written as a stream, in the order entries are created; members can't
+    # be changed or removed once written. Missing parent directories, as
+    # those of a common subdirectory, are added as members of their own.
+    local = False
+    SUFFIXES = (('.tar', 'x'), ('.tar.gz', 'x:gz'), ('.tgz', 'x:gz'), ('.tar.bz2', 'x:bz2'), ('.tar.xz', 'x:xz'))
+
+    def __init__(self, path):
+        import tarfile
+        Storage.__init__(self)
+        self.path = path
+        self.archive = tarfile.open(path, self.mode(path))
+        self.listings = {'': []}
+        self.stats = {'': directory_stat(0)}
+
+    @classmethod
+    def mode(cls, path):
+        # returns the mode for tarfile.open according to the suffix, or None
+        for suffix, mode in cls.SUFFIXES:
+            if path.endswith(suffix):
+                return mode
+        return None
+
+    def name(self, path):
+        name = os.path.relpath(path, self.path)
+        return '' if name == '.' else name.replace(os.sep, '/')
+
+    def add(self, path, member, fileA=None):
+        name = member.name = self.name(path)
+        parent = '/'.join(name.split('/')[:-1])
+        if name in self.stats:
+            raise storage_error('EEXIST', path)
+        if parent in self.stats and parent not in self.listings:
+            raise storage_error('ENOTDIR', path)
+        if parent not in self.listings:
+            self.mkdir(os.path.dirname(path))
+        self.archive.addfile(member, fileA)
+        self.listings[parent].append(name.split('/')[-1])
+        if member.isdir():
+            self.listings[name] = []
+        self.stats[name] = member_stat(member, len(self.stats))
+
+    def listdir(self, path):
+        return list(self.listings.get(self.name(path), ()))
+
+    def stat(self, path, follow_link):
+        return self.stats.get(self.name(path))
+
+    def open(self, path):
+        raise storage_error('EACCES', path)
+
+    def readlink(self, path):
+        raise storage_error('EACCES', path)
+
+    def write(self, path, fileA, statA):
+        import tarfile
+        member = tarfile.TarInfo()
+        member.size = statA.st_size
+        member.mtime = statA.st_mtime_ns / 1000000000.0
+        member.mode = stat.S_IMODE(statA.st_mode)
+        self.add(path, member, fileA)
+
+    def set_times(self, path, statA):
+        raise storage_error('EROFS', path)
+
+    def mkdir(self, path):
+        import tarfile
+        import time
+        member = tarfile.TarInfo()
+        member.type = tarfile.DIRTYPE
+        member.mode = 0o755
+        member.mtime = int(time.time())
+        self.add(path, member)
+
+    def symlink(self, link, path):
+        import tarfile
+        import time
+        member = tarfile.TarInfo()
+        member.type = tarfile.SYMTYPE
+        member.linkname = link
+        member.mode = 0o777
+        member.mtime = int(time.time())
+        self.add(path, member)
+
+    def remove(self, path):
+        raise storage_error('EROFS', path)
+
+    def rmdir(self, path):
+        raise storage_error('EROFS', path)
+
+    def close(self):
+        self.archive.close()
+
+class Verifier:
+    # Checks copies against a digest of the source computed while copying,
+    # by reading them back from disk and/or by recording them in a manifest
+    # (in the format of sha256sum and the like).
+    BUFSIZE = 0x100000
+
+    def __init__(self, algorithm='sha256', read_back=True, manifest=None):
+        self.lock = threading.Lock()
+        self.algorithm = algorithm
+        self.read_back = read_back
+        self.manifest = manifest
+
+    def new(self):
+        import hashlib
+        return hashlib.new(self.algorithm)
+
+    def release(self, fileB):
+        # Write a copy to disk and drop it from the cache, so that reading it
+        # back checks what actually got stored.
+        if self.read_back:
+            fileB.flush()
+            os.fsync(fileB.fileno())
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(fileB.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+    def check(self, pathB, hasher, tracer):
+        digest = hasher.hexdigest()
+        if self.read_back:
+            hasherB = self.new()
+            try:
+                with open(pathB, 'rb') as fileB:
+                    while True:
+                        block = fileB.read(self.BUFSIZE)
+                        if not block:
+                            break
+                        hasherB.update(block)
+            except EnvironmentError:
+                e = sys.exc_info()[1]
+                tracer.error(e.filename + ": " + e.strerror)
+                return False
+            if hasherB.hexdigest() != digest:
+                tracer.error(pathB + ": copy differs from source")
+                return False
+        if self.manifest is not None:
+            with self.lock:
+                self.manifest.write("%s  %s\n" % (digest, pathB))
+        return True
+
+def copy_file(pathA, pathsB, statA, tracer, verifier=None, set_times=True):
+    # Streams a source file into each destination file, reading it once.
+    # Returns the destinations that were written successfully.
+    BUFSIZE = 0x100000
+    hasher = verifier and verifier.new()
+    filesB = []
+    closedB = []
+    try:
+        with open(pathA, 'rb') as fileA:
+            for pathB in pathsB:
+                try:
+                    filesB.append((pathB, open(pathB, 'wb')))
+                except EnvironmentError:
+                    e = sys.exc_info()[1]
+                    tracer.error(e.filename + ": " + e.strerror)
+            while filesB:
+                block = fileA.read(BUFSIZE)
+                if not block:
+                    break
+                if hasher:
+                    hasher.update(block)
+                for pathB, fileB in filesB[:]:
+                    try:
+                        fileB.write(block)
+                    except EnvironmentError:
+                        e = sys.exc_info()[1]
+                        tracer.error(pathB + ": " + e.strerror)
+                        fileB.close()
+                        filesB.remove((pathB, fileB))
+    except EnvironmentError:
+        e = sys.exc_info()[1]
+        tracer.error(pathA + ": " + e.strerror)
+        for pathB, fileB in filesB:
+            fileB.close()
+        return []
+    for pathB, fileB in filesB:
+        try:
+            if verifier:
+                verifier.release(fileB)
+            fileB.close()
+        except EnvironmentError:
+            e = sys.exc_info()[1]
+            tracer.error(pathB + ": " + e.strerror)
+            fileB.close()
+        else:
+            closedB.append(pathB)
+    if verifier:
+        closedB = [pathB for pathB in closedB if verifier.check(pathB, hasher, tracer)]
+    # only copies found good get the source's time, so that the next run
+    # doesn't take a bad one for up to date
+    writtenB = []
+    for pathB in closedB:
+        try:
+            if set_times:
+                os.utime(pathB, ns=(statA.st_atime_ns, statA.st_mtime_ns))
+        except EnvironmentError:
+            e = sys.exc_info()[1]
+            tracer.error(pathB + ": " + e.strerror)
+        else:
+            writtenB.append(pathB)
+    return writtenB
+
+class PendingCopies:
+    # Copies of source files to several destinations, postponed until all
+    # destinations have been compared, so that each source file is read once.
+    # At most MAXCOPIES source files are held back; beyond that, the copies
+    # are made right away, and a source file may be read once more for the
+    # destinations compared afterwards.
+    MAXCOPIES = 10000
+
+    def __init__(self, tracer, verifier=None, copy_scheduler=None):
+        self.tracer = tracer
+        self.verifier = verifier
+        self.copy_scheduler = copy_scheduler
+        self.copies = {}
+
+    def add(self, pathA, pathB, statA, report=None):
+        # report, if given, is called with whether pathB was copied
+        statA, pathsB, reports = self.copies.setdefault(pathA, (statA, [], []))
+        pathsB.append(pathB)
+        reports.append(report)
+        if len(self.copies) >= self.MAXCOPIES:
+            self.flush(self.tracer)
+
+    def flush(self, tracer):
+        for pathA, (statA, pathsB, reports) in self.copies.items():
+            tracer.trace(pathA + ' ')
+            if self.copy_scheduler is not None:
+                self.copy_scheduler.submit(pathA, pathsB, statA, reports)
+            else:
+                written = copy_file(pathA, pathsB, statA, tracer, self.verifier)
+                for pathB, report in zip(pathsB, reports):
+                    if report is not None:
+                        report(pathB in written)
+        self.copies.clear()
+        tracer.leave()
+        if self.copy_scheduler is not None:
+            self.copy_scheduler.drain(tracer)
+
+class CopyScheduler:
+    # Copies files in the background while the comparison goes on. Small
+    # files are copied by several threads at once, and their timestamps are
+    # set in batches afterwards; large files are copied one at a time, so
+    # that they get the bandwidth instead of holding up the small ones.
+    # Submitting waits while too many files or bytes are in flight. Errors
+    # are collected and reported, along with each lane's throughput, when
+    # draining. Whether each destination was copied, timestamp included, is
+    # handed back on the submitting thread, at a later submit or when
+    # draining; copies cancelled before they started count as not made.
+    LARGE = 0x800000
+    MAXBYTES = 0x10000000
+    MAXFILES = 1024
+    BATCH = 64
+    MAXREPORTS = 10
+
+    def __init__(self, workers, verifier=None):
+        self.workers = workers
+        self.verifier = verifier
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.lanes = None
+
+    def start(self):
+        from concurrent.futures import ThreadPoolExecutor
+        self.lanes = {'small': ThreadPoolExecutor(self.workers), 'large': ThreadPoolExecutor(1)}
+        # per lane: files, bytes, time of first start and of last end
+        self.counts = dict((lane, [0, 0, None, None]) for lane in self.lanes)
+        self.files = 0
+        self.bytes = 0
+        self.times = []
+        self.errors = []
+        self.reports = []
+        # per copy submitted and not started yet, its reports
+        self.unstarted = {}
+        self.submitted = 0
+
+    def submit(self, pathA, pathsB, statA, reports=None):
+        # reports holds, for each destination, None or a function to call
+        # with whether it was copied
+        if self.lanes is None:
+            self.start()
+        self.deliver()
+        with self.condition:
+            # a file larger than MAXBYTES is let through on its own
+            while self.files and (self.files >= self.MAXFILES or self.bytes + statA.st_size > self.MAXBYTES):
+                self.condition.wait()
+            self.files += 1
+            self.bytes += statA.st_size
+            self.submitted += 1
+            key = self.submitted
+            self.unstarted[key] = reports = reports or [None] * len(pathsB)
+        lane = 'large' if statA.st_size >= self.LARGE else 'small'
+        self.lanes[lane].submit(self.copy, key, lane, pathA, pathsB, statA, reports)
+
+    def copy(self, key, lane, pathA, pathsB, statA, reports):
+        import time
+        with self.lock:
+            del self.unstarted[key]
+        start = time.monotonic()
+        batch = None
+        try:
+            written = copy_file(pathA, pathsB, statA, self, self.verifier, set_times=lane == 'large')
+        except Exception:
+            e = sys.exc_info()[1]
+            written = []
+            self.error("%s: %s" % (pathA, e))
+        with self.condition:
+            counts = self.counts[lane]
+            counts[0] += 1
+            counts[1] += statA.st_size
+            if counts[2] is None:
+                counts[2] = start
+            counts[3] = time.monotonic()
+            self.files -= 1
+            self.bytes -= statA.st_size
+            self.condition.notify()
+            for pathB, report in zip(pathsB, reports):
+                if lane == 'small' and pathB in written:
+                    # done once its timestamp is set too
+                    self.times.append((pathB, statA, report))
+                else:
+                    self.reports.append((report, pathB in written))
+            if len(self.times) >= self.BATCH:
+                batch, self.times = self.times, []
+        if batch:
+            self.setTimes(batch)
+
+    def setTimes(self, batch):
+        for pathB, statA, report in batch:
+            try:
+                os.utime(pathB, ns=(statA.st_atime_ns, statA.st_mtime_ns))
+            except EnvironmentError:
+                e = sys.exc_info()[1]
+                self.error(pathB + ": " + e.strerror)
+                done = False
+            else:
+                done = True
+            with self.lock:
+                self.reports.append((report, done))
+
+    def deliver(self):
+        # hands the outcomes of the copies finished so far to their reports
+        with self.lock:
+            reports, self.reports = self.reports, []
+        for report, done in reports:
+            if report is not None:
+                report(done)
+
+    def error(self, str):
+        # stands in for the tracer in copy_file, on the copying threads
+        with self.lock:
+            self.errors.append(str)
+
+    def drain(self, tracer, cancel=False):
+        # waits for the copies submitted, or only those already started if
+        # cancelled, then reports what happened
+        if self.lanes is None:
+            return
+        for executor in self.lanes.values():
+            executor.shutdown(cancel_futures=cancel)
+        self.lanes = None
+        self.setTimes(self.times)
+        self.times = []
+        dropped = [report for reports in self.unstarted.values() for report in reports]
+        self.unstarted.clear()
+        self.reports.extend((report, False) for report in dropped)
+        self.deliver()
+        for lane in 'small', 'large':
+            files, bytes, start, end = self.counts[lane]
+            if files:
+                seconds = max(end - start, 0.001)
+                tracer.report("%s files: copied %i (%.1f MB) in %.1f s, %.1f MB/s" % (lane, files, bytes / 1e6, seconds, bytes / 1e6 / seconds))
+        for str in self.errors[:self.MAXREPORTS]:
+            tracer.error(str)
+        if len(self.errors) > self.MAXREPORTS:
+            tracer.error("%i more errors copying files" % (len(self.errors) - self.MAXREPORTS))
+        if dropped:
+            tracer.error("%i approved copies cancelled" % len(dropped))
+
+class Deduplicator:
+    # Creates new files whose contents equal that of a file copied earlier as
+    # clones of that copy (sharing its blocks, where the file system can) or,
+    # if hardlink is set and the modification times match, as hard links to
+    # it. Source files are hashed only once another new file of the same
+    # size turns up, and each source file at most once. Clones and links are
+    # made when flushing, after the copies they refer to are done, and only
+    # of copies not reported failed; failing that, files are copied after
+    # all.
+    MINSIZE = 0x1000
+    BUFSIZE = 0x100000
+    FICLONE = 0x40049409
+
+    def __init__(self, hardlink=False, tree_hasher=None):
+        self.hardlink = hardlink
+        self.tree_hasher = tree_hasher
+        self.can_clone = sys.platform.startswith('linux')
+        # per size, [pathA, statA, pathB, digest or None] of files copied
+        self.copies = {}
+        self.digests = {}
+        self.pending = []
+        self.failed = set()
+
+    def digest(self, path, st):
+        key = st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns
+        try:
+            return self.digests[key]
+        except KeyError:
+            pass
+        if self.tree_hasher is not None and st.st_size > self.tree_hasher.CHUNKSIZE:
+            digest = self.tree_hasher.digest(path)
+        else:
+            import hashlib
+            hasher = hashlib.blake2b()
+            with open(path, 'rb') as fileA:
+                while True:
+                    block = fileA.read(self.BUFSIZE)
+                    if not block:
+                        break
+                    hasher.update(block)
+            digest = hasher.hexdigest()
+        self.digests[key] = digest
+        return digest
+
+    def add(self, pathA, pathB, statA, report=None):
+        # returns True if pathB is to be created from an earlier copy, False
+        # if it is to be copied now; report, if given, is called when
+        # flushing with whether pathB was created
+        if statA.st_size < self.MINSIZE:
+            return False
+        copies = self.copies.setdefault(statA.st_size, [])
+        if copies:
+            try:
+                digest = self.digest(pathA, statA)
+                for copy in copies:
+                    if copy[3] is None:
+                        copy[3] = self.digest(copy[0], copy[1])
+                    if copy[3] == digest:
+                        self.pending.append((copy[2], copy[1], pathA, pathB, statA, report))
+                        return True
+            except EnvironmentError:
+                return False
+        else:
+            digest = None
+        copies.append([pathA, statA, pathB, digest])
+        return False
+
+    def copied(self, pathB, done):
+        # tells whether the copy to pathB was made, in full
+        if not done:
+            self.failed.add(pathB)
+
+    def link(self, pathB0, statA0, pathB, statA):
+        # returns True if linked
+        if not self.hardlink or statA0.st_mtime_ns != statA.st_mtime_ns:
+            return False
+        try:
+            os.link(pathB0, pathB)
+        except EnvironmentError:
+            return False
+        return True
+
+    def clone(self, pathB0, pathB, statA):
+        # returns True if cloned
+        if not self.can_clone:
+            return False
+        import errno
+        import fcntl
+        try:
+            with open(pathB0, 'rb') as fileB0:
+                with open(pathB, 'wb') as fileB:
+                    fcntl.ioctl(fileB.fileno(), self.FICLONE, fileB0.fileno())
+            os.utime(pathB, ns=(statA.st_atime_ns, statA.st_mtime_ns))
+        except EnvironmentError:
+            e = sys.exc_info()[1]
+            if e.errno in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.ENOSYS):
+                self.can_clone = False
+            return False
+        return True
+
+    def flush(self, tracer):
+        counts = {'linked': 0, 'cloned': 0, 'copied': 0}
+        bytes = 0
+        for pathB0, statA0, pathA, pathB, statA, report in self.pending:
+            tracer.trace(pathB + ' ')
+            done = True
+            usable = pathB0 not in self.failed
+            if usable and self.link(pathB0, statA0, pathB, statA):
+                counts['linked'] += 1
+                bytes += statA.st_size
+            elif usable and self.clone(pathB0, pathB, statA):
+                counts['cloned'] += 1
+                bytes += statA.st_size
+            elif copy_file(pathA, [pathB], statA, tracer):
+                counts['copied'] += 1
+            else:
+                done = False
+            if report is not None:
+                report(done)
+        del self.pending[:]
+        self.failed.clear()
+        tracer.leave()
+        if counts['linked'] or counts['cloned']:
+            tracer.report("duplicate files: linked %i, cloned %i (%.1f MB not copied), copied %i" % (counts['linked'], counts['cloned'], bytes / 1e6, counts['copied']))
+
+class TreeHasher:
+    # Hashes large files as a BLAKE2 tree over fixed size chunks, so that the
+    # chunks of one file are read and hashed by several threads in parallel.
+    CHUNKSIZE = 0x1000000
+
+    def __init__(self, workers):
+        from concurrent.futures import ThreadPoolExecutor
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(workers)
+
+    def leaf(self, fd, index, last):
+        import hashlib
+        chunk = os.pread(fd, self.CHUNKSIZE, index * self.CHUNKSIZE)
+        return hashlib.blake2b(chunk, fanout=0, depth=2, leaf_size=self.CHUNKSIZE, inner_size=64, node_offset=index, node_depth=0, last_node=last).digest()
+
+    def leaves(self, fds, size):
+        # Yields the digests of each chunk of the files, hashing ahead.
+        from collections import deque
+        chunks = max(1, (size + self.CHUNKSIZE - 1) // self.CHUNKSIZE)
+        pending = deque()
+        try:
+            for index in range(chunks):
+                pending.append([self.executor.submit(self.leaf, fd, index, index == chunks - 1) for fd in fds])
+                if len(pending) >= 2 * self.workers:
+                    yield [future.result() for future in pending.popleft()]
+            while pending:
+                yield [future.result() for future in pending.popleft()]
+        finally:
+            # don't let the files be closed under our feet
+            for futures in pending:
+                for future in futures:
+                    future.cancel()
+            for futures in pending:
+                for future in futures:
+                    if not future.cancelled():
+                        future.exception()
+
+    def digest(self, path):
+        import hashlib
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            root = hashlib.blake2b(fanout=0, depth=2, leaf_size=self.CHUNKSIZE, inner_size=64, node_offset=0, node_depth=1, last_node=True)
+            leaves = self.leaves([fd], os.fstat(fd).st_size)
+            try:
+                for leaf, in leaves:
+                    root.update(leaf)
+            finally:
+                leaves.close()
+            return root.hexdigest()
+        finally:
+            os.close(fd)
+
+    def equal(self, pathA, pathB):
+        # Compares two files of the same size chunk by chunk.
+        fdA = os.open(pathA, os.O_RDONLY)
+        try:
+            fdB = os.open(pathB, os.O_RDONLY)
+            try:
+                leaves = self.leaves([fdA, fdB], os.fstat(fdA).st_size)
+                try:
+                    for leafA, leafB in leaves:
+                        if leafA != leafB:
+                            return False
+                    return True
+                finally:
+                    leaves.close()
+            finally:
+                os.close(fdB)
+        finally:
+            os.close(fdA)
+
+class TreeRemover:
+    # Removes whole directory trees using several threads. Like the safe
+    # variant of shutil.rmtree, it opens, lists, unlinks and removes entries
+    # relative to the file descriptor of their directory, which is kept open
+    # until its subdirectories are done, and never follows symbolic links.
+    # Errors are collected and reported together.
+    MAXREPORTS = 10
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.safe = os.open in os.supports_dir_fd and os.scandir in os.supports_fd and os.unlink in os.supports_dir_fd and os.rmdir in os.supports_dir_fd
+
+    def remove(self, path, tracer):
+        # returns True if the whole tree was removed
+        import shutil
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.entries = 0
+        self.errors = []
+        if self.safe:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(self.workers) as self.executor:
+                self.executor.submit(self.removeDir, None, path, path)
+                while not self.done.wait(0.5):
+                    tracer.trace("%s: removed %i entries " % (path, self.entries))
+            del self.executor
+        else:
+            shutil.rmtree(path, onerror=lambda function, path, exc_info: self.errors.append((path, exc_info[1])))
+        tracer.leave()
+        for errorpath, e in self.errors[:self.MAXREPORTS]:
+            tracer.error(errorpath + ": " + e.strerror)
+        if len(self.errors) > self.MAXREPORTS:
+            tracer.error("%s: %i more errors" % (path, len(self.errors) - self.MAXREPORTS))
+        return not self.errors
+
+    def removeDir(self, parent, name, path):
+        # name is relative to the parent's directory, path is for messages
+        node = DirRemoval(parent, name, path)
+        try:
+            node.fd = os.open(name, os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0) | getattr(os, 'O_NOFOLLOW', 0), dir_fd=parent and parent.fd)
+            with os.scandir(node.fd) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        with self.lock:
+                            node.pending += 1
+                        self.executor.submit(self.removeDir, node, entry.name, os.path.join(path, entry.name))
+                    else:
+                        try:
+                            os.unlink(entry.name, dir_fd=node.fd)
+                        except EnvironmentError:
+                            self.fail(node, os.path.join(path, entry.name), sys.exc_info()[1])
+                        else:
+                            self.entries += 1
+        except EnvironmentError:
+            self.fail(node, path, sys.exc_info()[1])
+        finally:
+            self.finishDir(node)
+
+    def fail(self, node, path, e):
+        with self.lock:
+            self.errors.append((path, e))
+            while node is not None and not node.failed:
+                node.failed = True
+                node = node.parent
+
+    def finishDir(self, node):
+        # Once a directory and all its subdirectories are treated, remove it
+        # and tell its parent.
+        while node is not None:
+            with self.lock:
+                node.pending -= 1
+                if node.pending:
+                    return
+            if node.fd is not None:
+                os.close(node.fd)
+            if not node.failed:
+                try:
+                    if node.parent is None:
+                        os.rmdir(node.name)
+                    else:
+                        os.rmdir(node.name, dir_fd=node.parent.fd)
+                except EnvironmentError:
+                    self.fail(node.parent, node.path, sys.exc_info()[1])
+                else:
+                    self.entries += 1
+            node = node.parent
+        self.done.set()
+
+class DirRemoval:
+    def __init__(self, parent, name, path):
+        self.parent = parent
+        self.name = name
+        self.path = path
+        self.fd = None
+        self.pending = 1 # itself and subdirectories not yet removed
+        self.failed = False
+
 class Session:
-    def __init__(self, mastersession, commonsubdir, initialdecisions):
+    def __init__(self, mastersession, commonsubdir, initialdecisions, ancestors=(frozenset(), frozenset())):
         self.master = mastersession
         self.commonsubdir = commonsubdir
         self.__decisions = initialdecisions.copy()
+        # (st_dev, st_ino) of the directories containing this one, in source
+        # and target, when following links
+        self.ancestors = ancestors
 
     def getDecision(self, action):
         # returns True if permission will be granted
@@ -66,12 +1236,20 @@ class Session:
     def setDecision(self, action, granted):
         self.__decisions[action] = granted
 
-    def canIdo(self, action, subject):
+    def grantsAll(self, *actions):
+        # returns True if permission will be granted for each action without asking
+        for action in actions:
+            if not self.getDecision(action):
+                return False
+        return True
+
+    def canIdo(self, action, compair):
         # Recall or ask permission to do action, given (or not) explanation
-        # arg 2: name of subject to treat
+        # arg 2: ComPair of subject to treat
         # returns True if permission was granted
 
         tracer = self.master.tracer
+        subject = self.master.label + compair.subject
         if action.isIgnore():
             tracer.trace("%s %s" % (subject, action.reason))
             return False
@@ -86,7 +1264,7 @@ class Session:
                 choice += " YesInDir NoInDir"
             choice += " AllYes ZeroYes Quit"
             tracer.leave()
-            yn = self.master.chooser.ask("%s %s, %s? [%s] n\b" % (subject, action.reason, action.treatment, choice))
+            yn = self.master.ask(action, compair, "%s %s, %s? [%s] n\b" % (subject, action.reason, action.treatment, choice))
             if not yn:
                 return False
             elif yn[0] == 'n':
@@ -118,19 +1296,16 @@ class Session:
             subdirA = self.master.dirA
             subdirB = self.master.dirB
 
-        if not self.master.actionNewDir.isIgnore() and os.path.isdir(subdirA):
-            basenamesA = os.listdir(subdirA)
+        if not self.master.actionNewDir.isIgnore():
+            entriesA = self.master.source.scandir(subdirA, self.master.follow_link)
         else:
-            basenamesA = []
-        if not self.master.actionOldDir.isIgnore() and os.path.isdir(subdirB):
-            basenamesB = os.listdir(subdirB)
+            entriesA = None
+        if not self.master.actionOldDir.isIgnore():
+            entriesB = self.master.target.scandir(subdirB, self.master.follow_link)
         else:
-            basenamesB = []
-        if basenamesA and basenamesB:
-            basenames = list(set(basenamesA) | set(basenamesB))
-        else:
-            basenames = basenamesA or basenamesB
-        basenames.sort()
+            entriesB = None
+        listed = set(entriesA or ()) | set(entriesB or ())
+        basenames = sorted(listed)
         basename_aliases = set()
         for basename in basenames:
             if basename in basename_aliases:
@@ -139,41 +1314,68 @@ class Session:
                 subject = os.path.join(self.commonsubdir, basename)
             else:
                 subject = basename
-            compair = ComPair(self, subject)
+            if entriesA is None or entriesB is None:
+                compair = ComPair(self, subject)
+            else:
+                compair = ComPair(self, subject, (entriesA.get(basename), entriesB.get(basename)))
             compair.compare()
             for alt in (basename.upper(), basename.lower()):
-                if alt != basename:
+                # only another name listed can be skipped as an alias
+                if alt != basename and alt in listed:
                     if compair.statA is not None:
-                        try:
-                            statA2 = os.lstat(os.path.join(subdirA, alt))
-                        except EnvironmentError:
-                            pass
-                        else:
-                            if os.path.samestat(compair.statA, statA2):
-                                basename_aliases.add(alt)
+                        statA2 = self.master.source.stat(os.path.join(subdirA, alt), False)
+                        if statA2 is not None and os.path.samestat(compair.statA, statA2):
+                            basename_aliases.add(alt)
                     if compair.statB is not None:
-                        try:
-                            statB2 = os.lstat(os.path.join(subdirB, alt))
-                        except EnvironmentError:
-                            pass
-                        else:
-                            if os.path.samestat(compair.statB, statB2):
-                                basename_aliases.add(alt)
+                        statB2 = self.master.target.stat(os.path.join(subdirB, alt), False)
+                        if statB2 is not None and os.path.samestat(compair.statB, statB2):
+                            basename_aliases.add(alt)
 
-    def descend(self, subdir):
-        Session(mastersession=self.master, commonsubdir=subdir, initialdecisions=self.__decisions).run()
+    def descend(self, subdir, statA=None, statB=None):
+        ancestors = self.ancestors
+        if self.master.follow_link:
+            ancestors = tuple(keys if st is None else keys | {(st.st_dev, st.st_ino)} for keys, st in zip(ancestors, (statA, statB)))
+        Session(mastersession=self.master, commonsubdir=subdir, initialdecisions=self.__decisions, ancestors=ancestors).run()
 
 class MasterSession(Session):
-    def __init__(self, dirA, dirB, out, chooser, commonsubdir=None, clean=False, follow_link=False, do_everything=False, do_nothing=False, ignore_time=False, trust_time=False):
+    def __init__(self, dirA, dirB, out, chooser, commonsubdir=None, clean=False, follow_link=False, do_everything=False, do_nothing=False, ignore_time=False, trust_time=False, time_model=None, verifier=None, workers=1, snapshot=None, dedup=None, tracer=None, source=None, target=None, pending_copies=None, label=''):
         assert not(do_everything and do_nothing)
         assert not(ignore_time and trust_time)
+        assert not(dedup and verifier)
         Session.__init__(self, mastersession=self, commonsubdir=commonsubdir, initialdecisions={})
         self.dirA = dirA
         self.dirB = dirB
         self.follow_link = follow_link
+        self.snapshot = snapshot
+        self.source = source or Storage(snapshot)
+        self.target = target or Storage(snapshot)
+        if follow_link:
+            # (st_dev, st_ino) pairs of directories compared, to subjects
+            self.visited = {}
+            self.ancestors = tuple(frozenset() if st is None else frozenset([(st.st_dev, st.st_ino)]) for st in (self.source.stat(os.path.join(dirA, commonsubdir or ''), True), self.target.stat(os.path.join(dirB, commonsubdir or ''), True)))
         self.ignore_time = ignore_time
         self.trust_time = trust_time
-        self.tracer = Tracer(out)
+        self.time_model = time_model or TimeModel()
+        self.verifier = verifier
+        self.tree_remover = TreeRemover(workers)
+        # the shortcuts taken with threads work on local paths only
+        local = self.source.local and self.target.local
+        if workers > 1 and hasattr(os, 'pread') and local:
+            self.tree_hasher = TreeHasher(workers)
+        else:
+            self.tree_hasher = None
+        self.pending_copies = pending_copies
+        if workers > 1 and pending_copies is None and not clean and local:
+            self.copy_scheduler = CopyScheduler(workers, verifier)
+        else:
+            self.copy_scheduler = None
+        # dedup is 'clone' or 'link'
+        if dedup and pending_copies is None and not clean and local:
+            self.deduplicator = Deduplicator(hardlink=dedup == 'link', tree_hasher=self.tree_hasher)
+        else:
+            self.deduplicator = None
+        self.label = label
+        self.tracer = tracer or Tracer(out)
         self.chooser = chooser
         self.clean = clean
         if ignore_time:
@@ -216,19 +1418,54 @@ class MasterSession(Session):
             self.setDecision(self.actionChangedLink, do_everything)
         self.do_nothing = do_nothing
 
+    def run(self):
+        # the copies approved before quitting are made; when broken off
+        # otherwise, only those already started. Duplicates approved are
+        # created either way, from the source where their copy wasn't made.
+        cancel = False
+        try:
+            Session.run(self)
+            if self.snapshot is not None and not self.follow_link:
+                self.snapshot.prune(os.path.join(self.dirA, self.commonsubdir or ''))
+                self.snapshot.prune(os.path.join(self.dirB, self.commonsubdir or ''))
+        except SystemExit:
+            raise
+        except BaseException:
+            cancel = True
+            raise
+        finally:
+            try:
+                if self.copy_scheduler is not None:
+                    self.copy_scheduler.drain(self.tracer, cancel)
+            finally:
+                if self.deduplicator is not None:
+                    self.deduplicator.flush(self.tracer)
+
+    def close(self):
+        self.source.close()
+        self.target.close()
+        if self.tree_hasher is not None:
+            self.tree_hasher.executor.shutdown()
+
+    def ask(self, action, compair, prompt):
+        return self.chooser.ask(prompt)
+
     def TreatedCommonDir(self, compair):
         if self.clean:
             try:
-                os.rmdir(compair.getPathA())
+                self.source.rmdir(compair.getPathA())
             except:
                 pass
 
 class ComPair:
-    def __init__(self, session, subject):
+    def __init__(self, session, subject, stats=None):
         self.session = session
         self.subject = subject
-        self.setStatA()
-        self.setStatB()
+        if stats is None:
+            self.setStatA()
+            self.setStatB()
+        else:
+            self.statA, self.statB = stats
 
     def getPathA(self):
         return os.path.join(self.session.master.dirA, self.subject)
@@ -237,31 +1474,37 @@ class ComPair:
         return os.path.join(self.session.master.dirB, self.subject)
 
     def setStatA(self):
-        try:
-            if self.session.master.follow_link:
-                self.statA = os.stat(self.getPathA())
-            else:
-                self.statA = os.lstat(self.getPathA())
-        except EnvironmentError:
-            self.statA = None
+        master = self.session.master
+        self.statA = master.source.stat(self.getPathA(), master.follow_link)
 
     def setStatB(self):
-        try:
-            if self.session.master.follow_link:
-                self.statB = os.lstat(self.getPathB())
-            else:
-                self.statB = os.lstat(self.getPathB())
-        except EnvironmentError:
-            self.statB = None
+        master = self.session.master
+        self.statB = master.target.stat(self.getPathB(), master.follow_link)
 
     def descendSubdir(self):
-        self.session.descend(self.subject)
+        master = self.session.master
+        if master.follow_link and self.statA is not None and self.statB is not None:
+            key = self.statA.st_dev, self.statA.st_ino, self.statB.st_dev, self.statB.st_ino
+            if key in master.visited:
+                master.tracer.skip(self.subject, "was compared as " + master.visited[key])
+                return
+            master.visited[key] = self.subject
+        self.session.descend(self.subject, self.statA, self.statB)
+
+    def isLoop(self):
+        # returns True if, following links, the subject is a directory containing itself
+        for st, keys in zip((self.statA, self.statB), self.session.ancestors):
+            if st is not None and (st.st_dev, st.st_ino) in keys:
+                return True
+        return False
 
     def compare(self):
         master = self.session.master
         tracer = master.tracer
         if self.statA is None and self.statB is None:
             pass # suddenly removed
+        elif master.follow_link and self.isLoop():
+            tracer.skip(self.subject, "is a link to a directory containing it")
         elif self.statA is None:
             mode2 = self.statB[stat.ST_MODE]
             if stat.S_ISDIR(mode2):
@@ -278,42 +1521,42 @@ class ComPair:
             elif stat.S_ISLNK(mode1):
                 master.actionNewLink.performIfCan(self)
             else:
-                tracer.report(self.subject + " skipped - huh???")
+                tracer.skip(self.subject, "huh???")
         else:
             mode1 = self.statA[stat.ST_MODE]
             mode2 = self.statB[stat.ST_MODE]
             if stat.S_ISDIR(mode1) and stat.S_ISDIR(mode2):
+                tracer.classified(self, None)
                 self.descendSubdir()
                 master.TreatedCommonDir(self)
             elif stat.S_ISREG(mode1) and stat.S_ISREG(mode2):
                 action = self.cmpRegFiles()
                 if action is not None:
                     if action in (master.actionChangedFileUnknown, master.actionChangedTimestamp): # and self.session.getDecision(action) is None:
-                        tracer.report("%10i %s %s" % (self.statA[stat.ST_SIZE], datetime.fromtimestamp(self.statA[stat.ST_MTIME]).ctime(), master.dirA))
-                        tracer.report("%10i %s %s" % (self.statB[stat.ST_SIZE], datetime.fromtimestamp(self.statB[stat.ST_MTIME]).ctime(), master.dirB))
+                        tracer.compared(self)
                     action.performIfCan(self)
             elif stat.S_ISLNK(mode1) and stat.S_ISLNK(mode2):
-                link1 = os.readlink(self.getPathA())
-                link2 = os.readlink(self.getPathB())
+                link1 = master.source.readlink(self.getPathA())
+                link2 = master.target.readlink(self.getPathB())
                 if link1 == link2:
                     master.actionDuplicateFile.performIfCan(self)
                 else:
                     tracer.report(self.subject + " has changed as follows:\n- %s\n+ %s" % (link1, link2))
                     master.actionChangedLink.performIfCan(self)
             elif stat.S_ISLNK(mode1) and stat.S_ISREG(mode2):
-                tracer.report(self.subject + " skipped - is link in source and file in target!")
+                tracer.skip(self.subject, "is link in source and file in target!")
             elif stat.S_ISLNK(mode1) and stat.S_ISDIR(mode2):
-                tracer.report(self.subject + " skipped - is link in source and directory in target!")
+                tracer.skip(self.subject, "is link in source and directory in target!")
             elif stat.S_ISREG(mode1) and stat.S_ISLNK(mode2):
-                tracer.report(self.subject + " skipped - is file in source and link in target!")
+                tracer.skip(self.subject, "is file in source and link in target!")
             elif stat.S_ISDIR(mode1) and stat.S_ISLNK(mode2):
-                tracer.report(self.subject + " skipped - is directory in source and link in target!")
+                tracer.skip(self.subject, "is directory in source and link in target!")
             elif stat.S_ISREG(mode1) and stat.S_ISDIR(mode2):
-                tracer.report(self.subject + " skipped - is file in source and directory in target!")
+                tracer.skip(self.subject, "is file in source and directory in target!")
             elif stat.S_ISDIR(mode1) and stat.S_ISREG(mode2):
-                tracer.report(self.subject + " skipped - is directory in source and file in target!")
+                tracer.skip(self.subject, "is directory in source and file in target!")
             else:
-                tracer.report(self.subject + " skipped - huh???")
+                tracer.skip(self.subject, "huh???")
 
     def cmpRegFiles(self):
         # returns relevant action
@@ -322,8 +1565,7 @@ class ComPair:
         size1 = self.statA[stat.ST_SIZE]
         size2 = self.statB[stat.ST_SIZE]
         maxsize = max(size1, size2)
-        deltatime = self.statB[stat.ST_MTIME] - self.statA[stat.ST_MTIME]
-        equaltime = master.ignore_time or abs(deltatime) in (0, 1, 3599, 3600, 3601, 7199, 7200, 7201)
+        equaltime = master.ignore_time or master.time_model.equal(self.statA, self.statB)
         if maxsize == 0:
             if equaltime:
                 return master.actionDuplicateFile
@@ -342,25 +1584,28 @@ class ComPair:
         if blocks > 1:
             tracer.trace(self.subject + ' ')
             try:
-                with open(self.getPathA(), 'rb') as fileA:
-                    with open(self.getPathB(), 'rb') as fileB:
-                        equal = True
-                        progress = 0
-                        for block in range(blocks):
-                            update = False
-                            while block * PROGRESSION >= progress * blocks:
-                                progress += 1
-                                update = True
-                            if update:
-                                sys.stdout.write(str(PROGRESSION - progress) + '\b')
-                            b1 = fileA.read(BUFSIZE)
-                            b2 = fileB.read(BUFSIZE)
-                            equal = b1 is not None and b2 is not None and b1 == b2
-                            if not equal:
-                                break
+                if master.tree_hasher is not None and maxsize > master.tree_hasher.CHUNKSIZE:
+                    equal = master.tree_hasher.equal(self.getPathA(), self.getPathB())
+                else:
+                    with master.source.open(self.getPathA()) as fileA:
+                        with master.target.open(self.getPathB()) as fileB:
+                            equal = True
+                            progress = 0
+                            for block in range(blocks):
+                                update = False
+                                while block * PROGRESSION >= progress * blocks:
+                                    progress += 1
+                                    update = True
+                                if update:
+                                    tracer.countdown(PROGRESSION - progress)
+                                b1 = fileA.read(BUFSIZE)
+                                b2 = fileB.read(BUFSIZE)
+                                equal = b1 is not None and b2 is not None and b1 == b2
+                                if not equal:
+                                    break
             except EnvironmentError:
                 e = sys.exc_info()[1]
-                tracer.report(e.filename + ": " + e.strerror)
+                tracer.error((e.filename or self.subject) + ": " + e.strerror)
                 return None
             if equal:
                 if equaltime:
@@ -371,21 +1616,22 @@ class ComPair:
                 tracer.report("different but won't detail because files are too big")
                 return master.actionChangedFileUnknown
         else:
+            import io
             try:
-                fileA = open(self.getPathA())
+                fileA = io.TextIOWrapper(master.source.open(self.getPathA()))
                 textA = fileA.readlines()
                 fileA.close()
             except EnvironmentError:
                 e = sys.exc_info()[1]
-                tracer.report(e.filename + ": " + e.strerror)
+                tracer.error(e.filename + ": " + e.strerror)
                 return None
             try:
-                fileB = open(self.getPathB())
+                fileB = io.TextIOWrapper(master.target.open(self.getPathB()))
                 textB = fileB.readlines()
                 fileB.close()
             except EnvironmentError:
                 e = sys.exc_info()[1]
-                tracer.report(e.filename + ": " + e.strerror)
+                tracer.error(e.filename + ": " + e.strerror)
                 return None
             if textA == textB:
                 if equaltime:
@@ -405,6 +1651,7 @@ class ComPair:
                 tracer.report(self.subject + " different but won't detail because target version is binary")
                 return master.actionChangedFileUnknown
 
+            import difflib
             tracer.trace(self.subject + ' ')  # comparison might take a while, so give a clue
             difflines = [line for line in difflib.ndiff(textA, textB)]
             #if len(difflines) == 0:
@@ -417,6 +1664,10 @@ class ComPair:
 
 
 class Action:
+    # perform returns whether the action was done, or QUEUED if it's left
+    # to be done later, in which case the tracer hears of it from then
+    QUEUED = 'queued'
+
     def __init__(self, tracer, reason, treatment=None):
         self.tracer = tracer
         self.reason = reason
@@ -426,85 +1677,390 @@ class Action:
         return self.treatment is None
 
     def performIfCan(self, compair):
-        return compair.session.canIdo(self, compair.subject) and self.perform(compair)
+        self.tracer.classified(compair, self)
+        granted = compair.session.canIdo(self, compair)
+        snapshot = compair.session.master.snapshot
+        if granted and not self.isIgnore() and snapshot is not None:
+            # not all that's done shows in the directory's times
+            snapshot.forget(os.path.dirname(compair.getPathA()))
+            snapshot.forget(os.path.dirname(compair.getPathB()))
+        done = granted and self.perform(compair)
+        if done is not self.QUEUED:
+            self.tracer.performed(compair, self, granted, done)
+        return done
 
     def perform(self, compair):
         return True
 
 class CreateTgtDir(Action):
     def perform(self, compair):
-        os.mkdir(compair.getPathB())
+        compair.session.master.target.mkdir(compair.getPathB())
         compair.setStatB()
         compair.descendSubdir()
         return True
 
 class RemoveTgtDir(Action):
     def perform(self, compair):
+        master = compair.session.master
+        statB = master.target.stat(compair.getPathB(), False)
+        if statB is not None and stat.S_ISLNK(statB.st_mode):
+            # followed a link: remove the link, not what it points to
+            try:
+                master.target.remove(compair.getPathB())
+            except EnvironmentError:
+                e = sys.exc_info()[1]
+                self.tracer.error(e.filename + ": " + e.strerror)
+                return False
+            compair.setStatB()
+            return True
+        if master.target.local and compair.session.grantsAll(master.actionOldFile, master.actionOldDir):
+            removed = master.tree_remover.remove(compair.getPathB(), self.tracer)
+            compair.setStatB()
+            return removed
         compair.descendSubdir()
         try:
-            os.rmdir(compair.getPathB())
+            master.target.rmdir(compair.getPathB())
         except EnvironmentError:
             e = sys.exc_info()[1]
-            self.tracer.report(e.filename + ": " + e.strerror)
+            self.tracer.error(e.filename + ": " + e.strerror)
             return False
         compair.setStatB()
         return True
 
 class CopyTimestamp(Action):
     def perform(self, compair):
-        os.utime(compair.getPathB(), (compair.statA[stat.ST_ATIME], compair.statA[stat.ST_MTIME]))
+        master = compair.session.master
+        if master.target.local:
+            # don't change the time of other files through a hard link:
+            # give this one a copy of its own
+            statB = master.target.stat(compair.getPathB(), False)
+            if statB is not None and stat.S_ISREG(statB.st_mode) and statB.st_nlink > 1:
+                import shutil
+                import tempfile
+                dirB, basename = os.path.split(compair.getPathB())
+                try:
+                    fd, temppath = tempfile.mkstemp(prefix='.' + basename + '.', dir=dirB)
+                    os.close(fd)
+                    try:
+                        shutil.copyfile(compair.getPathB(), temppath)
+                        shutil.copymode(compair.getPathB(), temppath)
+                        os.replace(temppath, compair.getPathB())
+                    except BaseException:
+                        os.unlink(temppath)
+                        raise
+                except EnvironmentError:
+                    e = sys.exc_info()[1]
+                    self.tracer.error(compair.getPathB() + ": " + e.strerror)
+                    return False
+        master.target.set_times(compair.getPathB(), compair.statA)
         return True
 
 class CopyFile(Action):
     def perform(self, compair):
+        master = compair.session.master
+        if compair.statB is not None:
+            # don't write through a hard link into other files
+            statB = master.target.stat(compair.getPathB(), False)
+            if statB is not None and stat.S_ISREG(statB.st_mode) and statB.st_nlink > 1:
+                try:
+                    master.target.remove(compair.getPathB())
+                except EnvironmentError:
+                    e = sys.exc_info()[1]
+                    self.tracer.error(e.filename + ": " + e.strerror)
+                    return False
+        import functools
+        report = functools.partial(self.finish, compair)
+        pending_copies = master.pending_copies
+        if pending_copies is not None:
+            pending_copies.add(compair.getPathA(), compair.getPathB(), compair.statA, report)
+            return self.QUEUED
+        deduplicator = master.deduplicator
+        if deduplicator is not None and compair.statB is None and deduplicator.add(compair.getPathA(), compair.getPathB(), compair.statA, report):
+            return self.QUEUED
+        copy_scheduler = master.copy_scheduler
+        if copy_scheduler is not None:
+            copy_scheduler.submit(compair.getPathA(), [compair.getPathB()], compair.statA, [report])
+            return self.QUEUED
+        if not (master.source.local and master.target.local):
+            try:
+                with master.source.open(compair.getPathA()) as fileA:
+                    master.target.write(compair.getPathB(), fileA, compair.statA)
+                compair.setStatB()
+            except EnvironmentError:
+                e = sys.exc_info()[1]
+                self.tracer.error(e.filename + ": " + e.strerror)
+                return False
+            else:
+                return True
+        verifier = master.verifier
+        if verifier is not None:
+            written = copy_file(compair.getPathA(), [compair.getPathB()], compair.statA, self.tracer, verifier)
+            compair.setStatB()
+            return bool(written)
+        import shutil
         try:
             shutil.copyfile(compair.getPathA(), compair.getPathB())
-            os.utime(compair.getPathB(), (compair.statA[stat.ST_ATIME], compair.statA[stat.ST_MTIME]))
+            os.utime(compair.getPathB(), ns=(compair.statA.st_atime_ns, compair.statA.st_mtime_ns))
             compair.setStatB()
         except EnvironmentError:
             e = sys.exc_info()[1]
-            self.tracer.report(e.filename + ": " + e.strerror)
+            self.tracer.error(e.filename + ": " + e.strerror)
+            if master.deduplicator is not None:
+                master.deduplicator.copied(compair.getPathB(), False)
             return False
         else:
             return True
 
+    def finish(self, compair, done):
+        # a copy left to be made later is over
+        compair.setStatB()
+        if compair.session.master.deduplicator is not None:
+            compair.session.master.deduplicator.copied(compair.getPathB(), done)
+        self.tracer.performed(compair, self, True, done)
+
 class CopyLink(Action):
     def perform(self, compair):
-        link = os.readlink(compair.getPathA())
+        master = compair.session.master
+        link = master.source.readlink(compair.getPathA())
         try:
-            os.unlink(compair.getPathB())
+            if compair.statB is not None:
+                master.target.remove(compair.getPathB())
         except EnvironmentError:
             e = sys.exc_info()[1]
-            self.tracer.report(e.filename + ": " + e.strerror)
+            self.tracer.error(e.filename + ": " + e.strerror)
             return False
-        os.symlink(link, compair.getPathB())
+        master.target.symlink(link, compair.getPathB())
         compair.setStatB()
         return True
 
 class RemoveTgtFile(Action):
     def perform(self, compair):
         try:
-            os.unlink(compair.getPathB())
+            compair.session.master.target.remove(compair.getPathB())
         except EnvironmentError:
             e = sys.exc_info()[1]
-            self.tracer.report(e.filename + ": " + e.strerror)
+            self.tracer.error(e.filename + ": " + e.strerror)
             return False
         compair.setStatB()
         return True
 
 class RemoveSrcFile(Action):
     def perform(self, compair):
-        os.unlink(compair.getPathA())
+        compair.session.master.source.remove(compair.getPathA())
         return True
 
 class RemoveSrcDir(Action):
     def perform(self, compair):
+        master = compair.session.master
+        statA = master.source.stat(compair.getPathA(), False)
+        if statA is not None and stat.S_ISLNK(statA.st_mode):
+            # followed a link: remove the link, not what it points to
+            master.source.remove(compair.getPathA())
+            return True
+        if master.source.local and compair.session.grantsAll(master.actionNewFile, master.actionNewLink, master.actionNewDir):
+            return master.tree_remover.remove(compair.getPathA(), self.tracer)
         try:
             compair.descendSubdir()
-            os.rmdir(compair.getPathA())
+            master.source.rmdir(compair.getPathA())
         except:
             pass
 
+class Outcome:
+    # What became of one entry, as yielded by iterate and iterate_async.
+    # kind is 'entry' for a directory in common, 'action' for an entry an
+    # action was classified for (action.treatment is None if there's nothing
+    # to do), 'skip' with the reason in text, 'error' with the message in
+    # text, or 'ask' when passed to a decide function.
+    def __init__(self, kind, subject, statA=None, statB=None, action=None, granted=None, done=None, text=None):
+        self.kind = kind
+        self.subject = subject
+        self.statA = statA
+        self.statB = statB
+        self.action = action
+        self.granted = granted
+        self.done = done
+        self.text = text
+
+    def __repr__(self):
+        return "Outcome(%r, %r, action=%r, granted=%r, done=%r, text=%r)" % (self.kind, self.subject, self.action and self.action.reason, self.granted, self.done, self.text)
+
+class OutcomeTracer(Tracer):
+    # Hands Outcomes to a function instead of writing text
+    def __init__(self, put):
+        Tracer.__init__(self, None)
+        self.put = put
+        self.stats = {}
+
+    def report(self, str):
+        pass
+
+    def error(self, str):
+        self.errors += 1
+        self.put(Outcome('error', None, text=str))
+
+    def trace(self, str):
+        pass
+
+    def countdown(self, n):
+        pass
+
+    def skip(self, subject, why):
+        self.put(Outcome('skip', subject, text=why))
+
+    def compared(self, compair):
+        pass
+
+    def classified(self, compair, action):
+        if action is None:
+            self.put(Outcome('entry', compair.subject, compair.statA, compair.statB))
+        else:
+            self.stats[id(compair)] = compair.statA, compair.statB
+
+    def performed(self, compair, action, granted, done):
+        statA, statB = self.stats.pop(id(compair))
+        self.put(Outcome('action', compair.subject, statA, statB, action, bool(granted), bool(done)))
+
+    def end(self, str = ''):
+        pass
+
+    def leave(self):
+        pass
+
+class CallbackSession(MasterSession):
+    # A MasterSession asking a function instead of a Chooser. The function
+    # gets an Outcome of kind 'ask' and returns True, False (or None), or
+    # one of the answers a Chooser may give.
+    def __init__(self, dirA, dirB, decide, **options):
+        MasterSession.__init__(self, dirA, dirB, out=None, chooser=None, **options)
+        self.decide = decide
+
+    def ask(self, action, compair, prompt):
+        answer = self.decide(Outcome('ask', compair.subject, compair.statA, compair.statB, action))
+        if answer is True:
+            return 'y'
+        elif not answer:
+            return 'n'
+        else:
+            return answer
+
+class Cancelled(Exception):
+    pass
+
+def run_outcomes(dirA, dirB, decide, put, options):
+    # Runs a CallbackSession, handing each Outcome to put and finally None,
+    # or the exception that broke off the session. put raises Cancelled if
+    # nobody is interested anymore.
+    try:
+        try:
+            CallbackSession(dirA, dirB, decide or (lambda outcome: False), tracer=OutcomeTracer(put), **options).run()
+        except Cancelled:
+            raise
+        except SystemExit:
+            pass # answered Quit
+        except BaseException:
+            put(sys.exc_info()[1])
+            return
+        put(None)
+    except Cancelled:
+        pass
+
+def iterate(dirA, dirB, decide=None, backlog=1000, **options):
+    # Synchronizes like MasterSession, yielding an Outcome per entry while the
+    # walk proceeds in another thread, up to backlog outcomes ahead. decide is
+    # called in that thread; without it, anything not decided by
+    # do_everything or do_nothing is refused. Closing the generator stops
+    # the walk.
+    import queue
+    outcomes = queue.Queue(backlog)
+    stop = threading.Event()
+    def put(outcome):
+        while True:
+            if stop.is_set():
+                raise Cancelled()
+            try:
+                outcomes.put(outcome, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+    walker = threading.Thread(target=run_outcomes, args=(dirA, dirB, decide, put, options), daemon=True)
+    walker.start()
+    try:
+        while True:
+            outcome = outcomes.get()
+            if outcome is None:
+                break
+            if isinstance(outcome, BaseException):
+                raise outcome
+            yield outcome
+    finally:
+        stop.set()
+        walker.join()
+
+async def iterate_async(dirA, dirB, decide=None, backlog=1000, executor=None, **options):
+    # Like iterate, as an asynchronous generator. The walk runs in executor
+    # (by default the event loop's), and decide may be a coroutine function,
+    # in which case it runs in the event loop.
+    import asyncio
+    loop = asyncio.get_running_loop()
+    outcomes = asyncio.Queue(backlog)
+    stop = threading.Event()
+    def put(outcome):
+        if stop.is_set():
+            raise Cancelled()
+        asyncio.run_coroutine_threadsafe(outcomes.put(outcome), loop).result()
+    def decide_in_thread(outcome):
+        answer = decide(outcome)
+        if asyncio.iscoroutine(answer):
+            answer = asyncio.run_coroutine_threadsafe(answer, loop).result()
+        return answer
+    walker = loop.run_in_executor(executor, run_outcomes, dirA, dirB, decide and decide_in_thread, put, options)
+    try:
+        while True:
+            outcome = await outcomes.get()
+            if outcome is None:
+                break
+            if isinstance(outcome, BaseException):
+                raise outcome
+            yield outcome
+    finally:
+        stop.set()
+        while not walker.done():
+            while not outcomes.empty():
+                outcomes.get_nowait()
+            await asyncio.wait([walker], timeout=0.1)
+
+class FanOutSession:
+    # Synchronizes one source directory to several destination directories,
+    # listing the source once and reading each source file once.
+    def __init__(self, dirA, dirsB, out, chooser, **options):
+        assert not options.get('clean')
+        self.tracer = options.pop('tracer', None) or Tracer(out)
+        self.verifier = options.get('verifier')
+        self.snapshot = options.get('snapshot')
+        source = SourceCache(self.snapshot)
+        if options.get('workers', 1) > 1:
+            copy_scheduler = CopyScheduler(options['workers'], self.verifier)
+        else:
+            copy_scheduler = None
+        self.pending_copies = PendingCopies(self.tracer, self.verifier, copy_scheduler)
+        self.masters = [MasterSession(dirA, dirB, out, chooser, tracer=self.tracer, source=source, pending_copies=self.pending_copies, label=os.path.join(dirB, ''), **options) for dirB in dirsB]
+
+    def run(self):
+        # the copies approved so far are made even if the run is broken off
+        try:
+            for master in self.masters:
+                master.run()
+        finally:
+            self.pending_copies.flush(self.tracer)
+
+    def close(self):
+        for master in self.masters:
+            master.close()
+
+def is_archive(path):
+    import tarfile
+    return os.path.isfile(path) and tarfile.is_tarfile(path)
+
 def is_binary(lines):
     for line in lines:
         for char in line:
@@ -512,37 +2068,206 @@ def is_binary(lines):
                 return True
     return False
 
-if __name__ == '__main__':
-    parser = OptionParser(usage="%prog [-L] [-c] [-r] [ -s | -i ] [ -y | -n ] source-directory destination-directory [-r] [ common-subdirectory ]")
+def make_parser(job=False):
+    from optparse import OptionParser
+    if job:
+        parser = OptionParser(usage="[options] source-directory destination-directory [ common-subdirectory ]")
+        # report bad options of one job instead of exiting the process
+        def error(msg):
+            raise ValueError(msg)
+        parser.error = error
+    else:
+        parser = OptionParser(usage="%prog [-L] [-c] [-r] [ -s | -i ] [ -y | -n ] [-t seconds] [-F] [-o hours] [-v] [-m manifest] [-w workers] [-D clone|link] [-S snapshot] [-e fd] source-directory destination-directory [-d destination-directory]... [-r] [ common-subdirectory ]\n       %prog [options] -b job-file [-j jobs]", description="The source directory may also be a tar archive, and the destination directory a tar archive to create (.tar, .tar.gz, .tgz, .tar.bz2 or .tar.xz). A compressed source archive is first decompressed into a temporary file, which takes as much space as the archive's contents.")
     parser.add_option("-c", action="store_true", dest="clean", help="clean source instead")
+    parser.add_option("-d", action="append", dest="more_dirsB", default=[], help="also synchronize to this destination directory (repeatable)")
     parser.add_option("-r", action="store_true", dest="reverse", help="reverse source and destination")
     parser.add_option("-s", action="store_true", dest="strict", help="compare contents even if timestamp and size match")
     parser.add_option("-i", action="store_true", dest="ignore_time", help="ignore time difference - consider equal if only size matches")
+    parser.add_option("-t", type="float", dest="tolerance", default=1, help="consider times equal if they differ by at most this many seconds, on top of the granularity of the file systems, default 1")
+    parser.add_option("-F", action="store_true", dest="fat", default=False, help="allow for times stored in whole even seconds, as on FAT file systems")
+    parser.add_option("-o", type="int", dest="offset_hours", default=2, help="consider times equal if they differ by up to this many whole hours (time zones, daylight saving time), default 2")
+    parser.add_option("-v", action="store_true", dest="verify", help="verify copies by reading them back and comparing with a digest of the source taken while copying")
+    parser.add_option("-m", dest="manifest", help="append the digest of each copy to this file, for later audit")
+    parser.add_option("-w", type="int", dest="workers", default=1, help="number of threads comparing large files in parallel chunks, removing whole trees, and copying small files")
+    parser.add_option("-D", type="choice", choices=("clone", "link"), dest="dedup", help="create new files identical to one copied before as clones of it, or as hard links if their times match too (clone or link)")
+    parser.add_option("-S", dest="snapshot", help="remember directory listings and the status of their entries in this file, to reuse them in the next run for directories that haven't changed; misses files modified in place until their directory changes; not used with -L")
+    parser.add_option("-e", type="int", dest="event_fd", help="write events as JSON lines to this file descriptor, instead of text to the terminal; needs -y or -n")
     parser.add_option("-L", action="store_true", dest="follow_link", help="follow symbolic links - otherwise treat link as files")
-    parser.add_option("-y", action="store_true", dest="do_everything", help="always anwer yes")
-    parser.add_option("-n", action="store_true", dest="do_nothing", help="always answer no")
-    options, args = parser.parse_args()
+    parser.add_option("-y", action="store_true", dest="do_everything", default=False, help="always anwer yes")
+    parser.add_option("-n", action="store_true", dest="do_nothing", default=False, help="always answer no")
+    if not job:
+        parser.add_option("-b", dest="job_file", help="synchronize each pair of directories listed, one per line with options, in this file")
+        parser.add_option("-j", type="int", dest="jobs", default=1, help="number of jobs in the job file to run at the same time, each needing -y or -n")
+    return parser
+
+def check_options(parser, options, args):
     if options.do_everything and options.do_nothing:
         parser.error("Can't have both options")
         sys.exit(2)
     if options.strict and options.ignore_time:
         parser.error("Can't have both options")
         sys.exit(2)
-    if len(args) not in (2, 3) or not os.path.isdir(args[0]) or not os.path.isdir(args[1]):
+    if options.event_fd is not None and not (options.do_everything or options.do_nothing):
+        parser.error("Can't ask questions while writing events")
+        sys.exit(2)
+    if options.workers < 1:
+        parser.error("Need at least 1 worker")
+        sys.exit(2)
+    if options.tolerance < 0 or options.offset_hours < 0:
+        parser.error("Can't have negative tolerance")
+        sys.exit(2)
+    if len(args) not in (2, 3):
         parser.error("2 paths to directories needed")
         sys.exit(2)
+    dirA, dirB = args[0:2]
+    if options.reverse:
+        dirA, dirB = dirB, dirA
+    # the source may be a tar archive, and the target a new one
+    if not (os.path.isdir(dirA) or is_archive(dirA)) or not (os.path.isdir(dirB) or not os.path.exists(dirB) and TarTarget.mode(dirB)):
+        parser.error("2 paths to directories needed")
+        sys.exit(2)
+    if options.dedup and (options.more_dirsB or options.verify or options.manifest):
+        parser.error("Can't deduplicate when verifying or with several destinations")
+        sys.exit(2)
+    if not (os.path.isdir(dirA) and os.path.isdir(dirB)) and (options.clean or options.more_dirsB or options.verify or options.manifest):
+        parser.error("Can't clean, verify or have several destinations with archives")
+        sys.exit(2)
+    if options.more_dirsB and (options.clean or options.reverse):
+        parser.error("Can't have several destinations when cleaning or reversing")
+        sys.exit(2)
+    for dirB in options.more_dirsB:
+        if not os.path.isdir(dirB):
+            parser.error("%s is not a directory" % dirB)
+            sys.exit(2)
 
+def make_session(options, args, out, tracer=None):
     #------------------------------------#
     # application specific customization #
     #------------------------------------#
     dirA,dirB = args[0:2]
     if options.reverse:
         dirA,dirB = dirB,dirA
-    master = MasterSession(dirA, dirB, commonsubdir=len(args) > 2 and args[2], clean=options.clean, follow_link=options.follow_link, do_everything=options.do_everything, do_nothing=options.do_nothing, ignore_time=options.ignore_time, trust_time=not options.strict, chooser=Chooser(), out=sys.stdout)
+    if options.verify or options.manifest:
+        verifier = Verifier(read_back=bool(options.verify), manifest=options.manifest and open(options.manifest, 'a'))
+    else:
+        verifier = None
+    snapshot = options.snapshot and DirSnapshot.shared(options.snapshot)
+    time_model = TimeModel(tolerance_ns=int(options.tolerance * 1000000000), offsets_ns=[h * 3600000000000 for h in range(options.offset_hours + 1)], fat=options.fat)
+    source = None if os.path.isdir(dirA) else TarSource(dirA)
+    target = None if os.path.isdir(dirB) else TarTarget(dirB)
+    if options.more_dirsB:
+        return FanOutSession(dirA, [dirB] + options.more_dirsB, commonsubdir=len(args) > 2 and args[2], follow_link=options.follow_link, do_everything=options.do_everything, do_nothing=options.do_nothing, ignore_time=options.ignore_time, trust_time=not options.strict, time_model=time_model, verifier=verifier, workers=options.workers, snapshot=snapshot, tracer=tracer, chooser=Chooser(), out=out)
+    else:
+        return MasterSession(dirA, dirB, commonsubdir=len(args) > 2 and args[2], clean=options.clean, follow_link=options.follow_link, do_everything=options.do_everything, do_nothing=options.do_nothing, ignore_time=options.ignore_time, trust_time=not options.strict, time_model=time_model, verifier=verifier, workers=options.workers, snapshot=snapshot, dedup=options.dedup, tracer=tracer, source=source, target=target, chooser=Chooser(), out=out)
 
+def make_tracer(options):
+    if options.event_fd is not None:
+        return EventTracer(os.fdopen(options.event_fd, 'wb', 0x10000, closefd=False))
+    else:
+        return None
+
+def run_session(master, stop=False):
+    # returns True if completed without errors; if stop is set, being
+    # cancelled is passed on to stop whatever runs the session
     try:
         master.run()
     except KeyboardInterrupt:
         master.tracer.report('cancelled')
+        if stop:
+            raise
+        return False
+    else:
+        return master.tracer.errors == 0
+    finally:
+        master.tracer.finish()
+        master.close()
+        if master.verifier and master.verifier.manifest:
+            master.verifier.manifest.close()
+        if master.snapshot:
+            master.snapshot.save()
+
+def run_job(options, line, out, interactive):
+    # returns True if the job was valid and completed without errors
+    import shlex
+    parser = make_parser(job=True)
+    try:
+        argv = shlex.split(line)
+        options, args = parser.parse_args(argv, values=options)
+        # a job's own -y or -n, -s or -i, overrides its counterpart given for all jobs
+        own, args = parser.parse_args(argv)
+        if own.do_everything or own.do_nothing:
+            options.do_everything, options.do_nothing = own.do_everything, own.do_nothing
+        if own.strict or own.ignore_time:
+            options.strict, options.ignore_time = own.strict, own.ignore_time
+        check_options(parser, options, args)
+        if not interactive and not (options.do_everything or options.do_nothing):
+            parser.error("Can't ask questions while running several jobs")
+        if not interactive and options.event_fd is not None:
+            parser.error("Can't write events while running several jobs")
+        master = make_session(options, args, out, make_tracer(options))
+    except (ValueError, EnvironmentError):
+        out.write("%s: %s\n" % (line, sys.exc_info()[1]))
+        return False
+    # a job that breaks down fails on its own, leaving the batch to go on
+    try:
+        return run_session(master, stop=True)
+    except Exception:
+        out.write("%s: %s\n" % (line, sys.exc_info()[1]))
+        return False
+
+def run_batch(options, out):
+    # Runs each line in the job file as if syncdir was invoked with it,
+    # in the same process. Returns the exit status. Being cancelled stops
+    # the batch: jobs not started yet are not run.
+    import copy
+    import io
+    with open(options.job_file) as job_file:
+        lines = [line.strip() for line in job_file]
+    lines = [line for line in lines if line and not line.startswith('#')]
+    # each job gets its own copy of the options, as some (-d) add to a list
+    results = []
+    if options.jobs > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(options.jobs) as executor:
+            outs = [io.StringIO() for line in lines]
+            futures = [executor.submit(run_job, copy.deepcopy(options), line, job_out, False) for line, job_out in zip(lines, outs)]
+            try:
+                for future, job_out in zip(futures, outs):
+                    results.append(future.result())
+                    out.write(job_out.getvalue())
+            except KeyboardInterrupt:
+                for future in futures:
+                    future.cancel()
+                out.write("batch cancelled\n")
     else:
-        master.tracer.leave()
+        try:
+            for line in lines:
+                results.append(run_job(copy.deepcopy(options), line, out, True))
+        except KeyboardInterrupt:
+            results.append(False)
+            out.write("batch cancelled\n")
+    failed = [line for line, result in zip(lines, results) if not result]
+    if len(results) < len(lines):
+        out.write("%i jobs, %i failed, %i not run\n" % (len(lines), len(failed), len(lines) - len(results)))
+    else:
+        out.write("%i jobs, %i failed\n" % (len(lines), len(failed)))
+    for line in failed:
+        out.write("failed: %s\n" % line)
+    return 1 if failed or len(results) < len(lines) else 0
+
+def main(argv):
+    parser = make_parser()
+    options, args = parser.parse_args(argv)
+    if options.job_file:
+        if args:
+            parser.error("Can't have both a job file and directories")
+            sys.exit(2)
+        if options.jobs < 1:
+            parser.error("Need at least 1 job")
+            sys.exit(2)
+        return run_batch(options, sys.stdout)
+    check_options(parser, options, args)
+    run_session(make_session(options, args, sys.stdout, make_tracer(options)))
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,36 @@
+import io
+import os
+import syncdir
+import tempfile
+import unittest
+
+class CopyLinkTestCase(unittest.TestCase):
+    def setUp(self):
+        self.src = tempfile.TemporaryDirectory(prefix="test_syncdir_", suffix=".lhs")
+        self.dst = tempfile.TemporaryDirectory(prefix="test_syncdir_", suffix=".rhs")
+        os.symlink("phile", os.path.join(self.src.name, "link"))
+        self.out = io.StringIO()
+    def tearDown(self):
+        self.dst.cleanup()
+        self.src.cleanup()
+        self.out.close()
+    def sync(self):
+        master = syncdir.MasterSession(self.src.name, self.dst.name, out=self.out, chooser=None, do_everything=True)
+        master.run()
+        self.assertEqual(master.tracer.errors, 0, self.out.getvalue())
+
+class CopyLinkTestCase_new(CopyLinkTestCase):
+    def runTest(self):
+        self.sync()
+        self.assertEqual(self.out.getvalue(), "link is new, link\n")
+        self.assertEqual(os.readlink(os.path.join(self.dst.name, "link")), "phile")
+
+class CopyLinkTestCase_changed(CopyLinkTestCase):
+    def runTest(self):
+        os.symlink("other phile", os.path.join(self.dst.name, "link"))
+        self.sync()
+        self.assertTrue(self.out.getvalue().endswith("link has changed as shown, relink\n"), self.out.getvalue())
+        self.assertEqual(os.readlink(os.path.join(self.dst.name, "link")), "phile")
+
+if __name__ == '__main__':
+    unittest.main()
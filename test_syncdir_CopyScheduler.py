@@ -0,0 +1,135 @@
+import io
+import os
+import syncdir
+import tempfile
+import time
+import unittest
+
+class SmallCopyScheduler(syncdir.CopyScheduler):
+    LARGE = 0x1000
+    MAXBYTES = 0x3000
+    MAXFILES = 4
+    BATCH = 3
+
+class Chooser:
+    # approves the first answers new files, then quits
+    def __init__(self, answers):
+        self.answers = answers
+    def ask(self, prompt):
+        self.answers -= 1
+        return 'y' if self.answers >= 0 else 'Q'
+
+class CopySchedulerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory(prefix="test_syncdir_")
+        self.src = os.path.join(self.dir.name, "src")
+        self.dst = os.path.join(self.dir.name, "dst")
+        os.mkdir(self.src)
+        os.mkdir(self.dst)
+        self.out = io.StringIO()
+        self.tracer = syncdir.Tracer(self.out)
+    def tearDown(self):
+        self.dir.cleanup()
+        self.out.close()
+    def write(self, name, size):
+        path = os.path.join(self.src, name)
+        with open(path, "wb") as f:
+            f.write(bytes(range(256)) * (size // 256) + b"x" * (size % 256))
+        os.utime(path, ns=(1000000000000000000, 1000000000000000000 + len(name)))
+        return path
+    def slow_down(self):
+        copy_file = syncdir.copy_file
+        def slow_copy_file(*args, **kwargs):
+            time.sleep(0.01)
+            return copy_file(*args, **kwargs)
+        syncdir.copy_file = slow_copy_file
+        self.addCleanup(setattr, syncdir, "copy_file", copy_file)
+    def assertCopied(self, name):
+        pathA = os.path.join(self.src, name)
+        pathB = os.path.join(self.dst, name)
+        with open(pathA, "rb") as fA, open(pathB, "rb") as fB:
+            self.assertEqual(fA.read(), fB.read())
+        self.assertEqual(os.stat(pathA).st_mtime_ns, os.stat(pathB).st_mtime_ns)
+
+class CopySchedulerTestCase_lanes(CopySchedulerTestCase):
+    def runTest(self):
+        scheduler = SmallCopyScheduler(3)
+        names = ["phile %02i" % i for i in range(20)] + ["large %i" % i for i in range(3)]
+        for name in names:
+            pathA = self.write(name, 0x4000 if name.startswith("large") else 100 + len(name))
+            scheduler.submit(pathA, [os.path.join(self.dst, name)], os.stat(pathA))
+        scheduler.drain(self.tracer)
+        for name in names:
+            self.assertCopied(name)
+        self.assertEqual(self.tracer.errors, 0)
+        lines = self.out.getvalue().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].startswith("small files: copied 20 "))
+        self.assertTrue(lines[1].startswith("large files: copied 3 (0.0 MB) "))
+        self.assertEqual((scheduler.files, scheduler.bytes), (0, 0))
+
+class CopySchedulerTestCase_errors(CopySchedulerTestCase):
+    def runTest(self):
+        scheduler = SmallCopyScheduler(2)
+        pathA = self.write("phile", 10)
+        scheduler.submit(pathA, [os.path.join(self.dst, "missing", "phile"), os.path.join(self.dst, "phile")], os.stat(pathA))
+        scheduler.drain(self.tracer)
+        self.assertCopied("phile")
+        self.assertEqual(self.tracer.errors, 1)
+        self.assertIn(os.path.join(self.dst, "missing", "phile") + ": No such file or directory\n", self.out.getvalue())
+
+class CopySchedulerTestCase_session(CopySchedulerTestCase):
+    def runTest(self):
+        os.mkdir(os.path.join(self.src, "pholder"))
+        names = ["phile %i" % i for i in range(10)] + [os.path.join("pholder", "phile")]
+        for name in names:
+            self.write(name, 1000)
+        syncdir.MasterSession(self.src, self.dst, out=self.out, chooser=None, do_everything=True, workers=4).run()
+        for name in names:
+            self.assertCopied(name)
+        self.assertEqual(self.out.getvalue().splitlines()[-1][:27], "small files: copied 11 (0.0")
+
+class CopySchedulerTestCase_fan_out(CopySchedulerTestCase):
+    def runTest(self):
+        dst2 = os.path.join(self.dir.name, "dst2")
+        os.mkdir(dst2)
+        self.write("phile", 1000)
+        syncdir.FanOutSession(self.src, [self.dst, dst2], out=self.out, chooser=None, do_everything=True, workers=2).run()
+        self.assertCopied("phile")
+        with open(os.path.join(dst2, "phile"), "rb") as f:
+            self.assertEqual(len(f.read()), 1000)
+        self.assertEqual(os.stat(os.path.join(dst2, "phile")).st_mtime_ns, os.stat(os.path.join(self.src, "phile")).st_mtime_ns)
+
+class CopySchedulerTestCase_quit(CopySchedulerTestCase):
+    def runTest(self):
+        # the copies approved before quitting are all made
+        self.slow_down()
+        names = ["phile %02i" % i for i in range(30)]
+        for name in names:
+            self.write(name, 100)
+        with self.assertRaises(SystemExit):
+            syncdir.MasterSession(self.src, self.dst, out=self.out, chooser=Chooser(20), workers=2).run()
+        self.assertEqual(sorted(os.listdir(self.dst)), names[:20])
+        for name in names[:20]:
+            self.assertCopied(name)
+
+class CopySchedulerTestCase_cancel(CopySchedulerTestCase):
+    def runTest(self):
+        # copies not started when cancelled are reported as not made
+        self.slow_down()
+        scheduler = SmallCopyScheduler(1)
+        reported = {}
+        for i in range(20):
+            name = "phile %02i" % i
+            pathA = self.write(name, 100)
+            scheduler.submit(pathA, [os.path.join(self.dst, name)], os.stat(pathA), [lambda done, name=name: reported.setdefault(name, done)])
+        scheduler.drain(self.tracer, cancel=True)
+        self.assertEqual(len(reported), 20)
+        copied = sorted(name for name, done in reported.items() if done)
+        self.assertEqual(sorted(os.listdir(self.dst)), copied)
+        self.assertLess(len(copied), 20)
+        self.assertIn("%i approved copies cancelled\n" % (20 - len(copied)), self.out.getvalue())
+        self.assertEqual(self.tracer.errors, 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+import errno
+import io
+import os
+import shutil
+import syncdir
+import tempfile
+import unittest
+
+class DeduplicatorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory(prefix="test_syncdir_")
+        self.src = os.path.join(self.dir.name, "src")
+        self.dst = os.path.join(self.dir.name, "dst")
+        os.mkdir(self.src)
+        os.mkdir(self.dst)
+        os.mkdir(os.path.join(self.src, "pholder"))
+        self.contents = bytes(range(256)) * 300
+        self.write("phile 1", self.contents, 1000000000000000000)
+        self.write(os.path.join("pholder", "phile 2"), self.contents, 1000000000000000000)
+        self.write("phile 3", self.contents, 1100000000000000000)
+        self.write("phile 4", self.contents[::-1], 1000000000000000000)
+        self.write("phile 5", self.contents[:-1], 1000000000000000000)
+        self.write("small 1", b"small\n", 1000000000000000000)
+        self.write("small 2", b"small\n", 1000000000000000000)
+        self.out = io.StringIO()
+    def tearDown(self):
+        self.dir.cleanup()
+        self.out.close()
+    def write(self, name, contents, mtime_ns):
+        path = os.path.join(self.src, name)
+        with open(path, "wb") as f:
+            f.write(contents)
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+    def sync(self, **options):
+        master = syncdir.MasterSession(self.src, self.dst, out=self.out, chooser=None, do_everything=True, **options)
+        master.run()
+        self.assertEqual(master.tracer.errors, 0, self.out.getvalue())
+        return master
+    def stat(self, name):
+        return os.stat(os.path.join(self.dst, name))
+    def assertCopied(self):
+        for dirpath, dirnames, filenames in os.walk(self.src):
+            for name in filenames:
+                pathA = os.path.join(dirpath, name)
+                pathB = os.path.join(self.dst, os.path.relpath(pathA, self.src))
+                with open(pathA, "rb") as fA, open(pathB, "rb") as fB:
+                    self.assertEqual(fA.read(), fB.read())
+                self.assertEqual(os.stat(pathA).st_mtime_ns, os.stat(pathB).st_mtime_ns)
+
+class DeduplicatorTestCase_link(DeduplicatorTestCase):
+    def runTest(self):
+        for workers in 1, 3:
+            with self.subTest(workers=workers):
+                self.dst = os.path.join(self.dir.name, "dst %i" % workers)
+                os.mkdir(self.dst)
+                master = self.sync(dedup="link", workers=workers)
+                self.assertCopied()
+                self.assertTrue(os.path.samestat(self.stat("phile 1"), self.stat(os.path.join("pholder", "phile 2"))))
+                self.assertFalse(os.path.samestat(self.stat("phile 1"), self.stat("phile 3")))
+                self.assertFalse(os.path.samestat(self.stat("small 1"), self.stat("small 2")))
+                self.assertIn("duplicate files: linked 1, ", self.out.getvalue())
+                # only files of a size seen before are hashed
+                self.assertEqual(len(master.deduplicator.digests), 4)
+
+class DeduplicatorTestCase_clone(DeduplicatorTestCase):
+    def runTest(self):
+        self.sync(dedup="clone")
+        self.assertCopied()
+        self.assertFalse(os.path.samestat(self.stat("phile 1"), self.stat(os.path.join("pholder", "phile 2"))))
+        self.assertEqual(self.stat("phile 1").st_nlink, 1)
+
+class DeduplicatorTestCase_overwrite(DeduplicatorTestCase):
+    def runTest(self):
+        self.sync(dedup="link")
+        self.write("phile 1", self.contents[::-1], 1200000000000000000)
+        self.sync()
+        self.assertCopied()
+        self.assertEqual(self.stat("phile 1").st_nlink, 1)
+        with open(os.path.join(self.dst, "pholder", "phile 2"), "rb") as f:
+            self.assertEqual(f.read(), self.contents)
+
+class DeduplicatorTestCase_failed(DeduplicatorTestCase):
+    def runTest(self):
+        # a copy broken off halfway isn't linked or cloned
+        def fail(pathB):
+            with open(pathB, "wb") as f:
+                f.write(self.contents[:1000])
+            raise OSError(errno.EIO, os.strerror(errno.EIO), pathB)
+        copyfile = shutil.copyfile
+        copy_file = syncdir.copy_file
+        def failing_copyfile(pathA, pathB, *args, **kwargs):
+            if os.path.basename(pathB) == "phile 1":
+                fail(pathB)
+            return copyfile(pathA, pathB, *args, **kwargs)
+        def failing_copy_file(pathA, pathsB, *args, **kwargs):
+            if os.path.basename(pathsB[0]) == "phile 1":
+                fail(pathsB[0])
+            return copy_file(pathA, pathsB, *args, **kwargs)
+        shutil.copyfile = failing_copyfile
+        syncdir.copy_file = failing_copy_file
+        self.addCleanup(setattr, shutil, "copyfile", copyfile)
+        self.addCleanup(setattr, syncdir, "copy_file", copy_file)
+        for workers in 1, 3:
+            for dedup in "link", "clone":
+                with self.subTest(workers=workers, dedup=dedup):
+                    self.dst = os.path.join(self.dir.name, "dst %i %s" % (workers, dedup))
+                    os.mkdir(self.dst)
+                    syncdir.MasterSession(self.src, self.dst, out=self.out, chooser=None, do_everything=True, dedup=dedup, workers=workers).run()
+                    self.assertEqual(self.stat(os.path.join("pholder", "phile 2")).st_nlink, 1)
+                    with open(os.path.join(self.dst, "pholder", "phile 2"), "rb") as f:
+                        self.assertEqual(f.read(), self.contents)
+
+class DeduplicatorTestCase_touch(DeduplicatorTestCase):
+    def runTest(self):
+        # a new time for one name of a hard link isn't given to the others
+        self.sync(dedup="link")
+        self.assertEqual(self.stat("phile 1").st_nlink, 2)
+        self.write("phile 1", self.contents, 1200000000000000000)
+        self.sync()
+        self.assertIn("phile 1 has different time, touch\n", self.out.getvalue())
+        self.assertCopied()
+        self.assertEqual(self.stat("phile 1").st_nlink, 1)
+        self.assertEqual(self.stat(os.path.join("pholder", "phile 2")).st_mtime_ns, 1000000000000000000)
+        with open(os.path.join(self.dst, "phile 1"), "rb") as f:
+            self.assertEqual(f.read(), self.contents)
+
+class DeduplicatorTestCase_quit(DeduplicatorTestCase):
+    def runTest(self):
+        # duplicates approved before quitting are created
+        class Chooser:
+            def __init__(self):
+                self.prompts = []
+            def ask(self, prompt):
+                self.prompts.append(prompt)
+                return 'y' if len(self.prompts) <= 3 else 'Q'
+        chooser = Chooser()
+        with self.assertRaises(SystemExit):
+            syncdir.MasterSession(self.src, self.dst, out=self.out, chooser=chooser, dedup="link").run()
+        # phile 3 duplicates phile 1
+        self.assertEqual(sorted(os.listdir(self.dst)), ["phile 1", "phile 3", "phile 4"])
+        with open(os.path.join(self.dst, "phile 3"), "rb") as f:
+            self.assertEqual(f.read(), self.contents)
+        self.assertEqual(self.stat("phile 3").st_mtime_ns, 1100000000000000000)
+
+if __name__ == '__main__':
+    unittest.main()
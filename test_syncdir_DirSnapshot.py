@@ -0,0 +1,170 @@
+import io
+import os
+import syncdir
+import tempfile
+import threading
+import unittest
+
+class DirSnapshotTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory(prefix="test_syncdir_")
+        self.snapshotpath = os.path.join(self.dir.name, "snapshot")
+        self.tree = os.path.join(self.dir.name, "tree")
+        os.mkdir(self.tree)
+        with open(os.path.join(self.tree, "phile"), "w") as f:
+            f.write("contents\n")
+        self.listed = []
+        self.lstated = []
+        real_listdir = os.listdir
+        real_lstat = os.lstat
+        def counting_listdir(path):
+            self.listed.append(path)
+            return real_listdir(path)
+        def counting_lstat(path, *args, **kwargs):
+            self.lstated.append(path)
+            return real_lstat(path, *args, **kwargs)
+        os.listdir = counting_listdir
+        os.lstat = counting_lstat
+        self.addCleanup(setattr, os, "listdir", real_listdir)
+        self.addCleanup(setattr, os, "lstat", real_lstat)
+    def tearDown(self):
+        self.dir.cleanup()
+    def snapshot(self, margin_ns):
+        snapshot = syncdir.DirSnapshot(self.snapshotpath)
+        snapshot.MARGIN_NS = margin_ns
+        return snapshot
+
+class DirSnapshotTestCase_reuse(DirSnapshotTestCase):
+    def runTest(self):
+        phile = os.path.join(self.tree, "phile")
+        snapshot = self.snapshot(-10**18)
+        entries = snapshot.scandir(self.tree)
+        self.assertEqual(list(entries), ["phile"])
+        self.assertEqual(self.listed, [self.tree])
+        self.assertEqual(self.lstated, [phile])
+        snapshot.save()
+        snapshot = self.snapshot(-10**18)
+        reused = snapshot.scandir(self.tree)
+        self.assertEqual(reused, entries)
+        self.assertEqual(reused["phile"].st_mtime_ns, entries["phile"].st_mtime_ns)
+        self.assertEqual(self.listed, [self.tree])
+        self.assertEqual(self.lstated, [phile])
+        # nothing new to save
+        ino = os.stat(self.snapshotpath).st_ino
+        snapshot.save()
+        self.assertEqual(os.stat(self.snapshotpath).st_ino, ino)
+        self.assertEqual(snapshot.scandir(phile), {})
+        self.assertEqual(snapshot.scandir(os.path.join(self.tree, "nothing")), {})
+        with open(os.path.join(self.tree, "other phile"), "w") as f:
+            f.write("contents\n")
+        self.assertEqual(sorted(snapshot.scandir(self.tree)), ["other phile", "phile"])
+        self.assertEqual(self.listed, [self.tree, self.tree])
+
+class DirSnapshotTestCase_recent(DirSnapshotTestCase):
+    def runTest(self):
+        snapshot = self.snapshot(10**18)
+        self.assertEqual(list(snapshot.scandir(self.tree)), ["phile"])
+        snapshot.save()
+        self.assertEqual(list(self.snapshot(10**18).scandir(self.tree)), ["phile"])
+        self.assertEqual(self.listed, [self.tree, self.tree])
+
+class DirSnapshotTestCase_forget(DirSnapshotTestCase):
+    def runTest(self):
+        snapshot = self.snapshot(-10**18)
+        snapshot.scandir(self.tree)
+        snapshot.forget(self.tree)
+        snapshot.save()
+        self.snapshot(-10**18).scandir(self.tree)
+        self.assertEqual(self.listed, [self.tree, self.tree])
+
+class DirSnapshotTestCase_old_format(DirSnapshotTestCase):
+    def runTest(self):
+        with open(self.snapshotpath, "w") as f:
+            f.write('{"%s": [[1, 2, 3, 4], ["phile"]]}' % self.tree)
+        self.assertEqual(self.snapshot(-10**18).entries, {})
+
+class DirSnapshotTestCase_shared(DirSnapshotTestCase):
+    def runTest(self):
+        snapshot = syncdir.DirSnapshot.shared(self.snapshotpath)
+        self.addCleanup(syncdir.DirSnapshot.opened.clear)
+        self.assertIs(syncdir.DirSnapshot.shared(os.path.join(self.dir.name, ".", "snapshot")), snapshot)
+        snapshot.MARGIN_NS = -10**18
+        errors = []
+        def save():
+            try:
+                for i in range(20):
+                    snapshot.forget(self.tree)
+                    snapshot.scandir(self.tree)
+                    snapshot.save()
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=save) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(sorted(os.listdir(self.dir.name)), ["snapshot", "tree"])
+        self.assertEqual(list(self.snapshot(-10**18).entries), [os.path.abspath(self.tree)])
+
+class DirSnapshotTestCase_touched(DirSnapshotTestCase):
+    def runTest(self):
+        # a timestamp copied to a file doesn't change its directory
+        src = os.path.join(self.dir.name, "src")
+        os.mkdir(src)
+        with open(os.path.join(src, "phile"), "w") as f:
+            f.write("contents\n")
+        os.utime(os.path.join(src, "phile"), ns=(10**18, 10**18))
+        for i in range(3):
+            out = io.StringIO()
+            snapshot = self.snapshot(-10**18)
+            syncdir.MasterSession(src, self.tree, out=out, chooser=None, do_everything=True, snapshot=snapshot).run()
+            snapshot.save()
+            if i == 0:
+                self.assertTrue(out.getvalue().endswith("phile has different time, touch\n"), out.getvalue())
+            else:
+                self.assertNotIn("touch", out.getvalue())
+
+class DirSnapshotTestCase_unchanged(DirSnapshotTestCase):
+    def runTest(self):
+        # a run over unchanged directories doesn't stat their entries
+        src = os.path.join(self.dir.name, "src")
+        os.mkdir(src)
+        os.mkdir(os.path.join(src, "pholder"))
+        for name in "phile", os.path.join("pholder", "phile"):
+            with open(os.path.join(src, name), "w") as f:
+                f.write("contents\n")
+        # the first run creates, the second remembers what it finds
+        for i in range(3):
+            del self.lstated[:]
+            out = io.StringIO()
+            snapshot = self.snapshot(-10**18)
+            syncdir.MasterSession(src, self.tree, out=out, chooser=None, do_everything=True, snapshot=snapshot).run()
+            snapshot.save()
+        self.assertNotIn("create", out.getvalue())
+        self.assertEqual(self.lstated, [])
+
+class DirSnapshotTestCase_gone(DirSnapshotTestCase):
+    def runTest(self):
+        # directories that went away are dropped from the snapshot
+        src = os.path.join(self.dir.name, "src")
+        os.makedirs(os.path.join(src, "gone", "deep"))
+        os.makedirs(os.path.join(self.dir.name, "elsewhere"))
+        snapshot = self.snapshot(-10**18)
+        snapshot.scandir(os.path.join(self.dir.name, "elsewhere"))
+        syncdir.MasterSession(src, self.tree, out=io.StringIO(), chooser=None, do_everything=True, snapshot=snapshot).run()
+        syncdir.MasterSession(src, self.tree, out=io.StringIO(), chooser=None, do_everything=True, snapshot=snapshot).run()
+        snapshot.save()
+        self.assertIn(os.path.join(self.tree, "gone", "deep"), self.snapshot(-10**18).entries)
+        os.rmdir(os.path.join(src, "gone", "deep"))
+        os.rmdir(os.path.join(src, "gone"))
+        snapshot = self.snapshot(-10**18)
+        syncdir.MasterSession(src, self.tree, out=io.StringIO(), chooser=None, do_everything=True, snapshot=snapshot).run()
+        snapshot.save()
+        self.assertFalse(os.path.exists(os.path.join(self.tree, "gone")))
+        entries = self.snapshot(-10**18).entries
+        self.assertEqual([key for key in entries if "gone" in key], [])
+        self.assertIn(os.path.join(self.dir.name, "elsewhere"), entries)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import io
+import json
+import os
+import stat
+import syncdir
+import tempfile
+import unittest
+
+class EventTracerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.src = tempfile.TemporaryDirectory(prefix="test_syncdir_", suffix=".lhs")
+        self.dst = tempfile.TemporaryDirectory(prefix="test_syncdir_", suffix=".rhs")
+        self.out = io.BytesIO()
+        self.tracer = syncdir.EventTracer(self.out)
+    def tearDown(self):
+        self.dst.cleanup()
+        self.src.cleanup()
+    def events(self):
+        return [json.loads(line) for line in self.out.getvalue().decode('ascii').splitlines()]
+
+class EventTracerTestCase_session(EventTracerTestCase):
+    def runTest(self):
+        for folder in self.src, self.dst:
+            os.mkdir(os.path.join(folder.name, "pholder"))
+        os.mkdir(os.path.join(self.src.name, "thing"))
+        with open(os.path.join(self.dst.name, "thing"), "w") as f:
+            f.write("contents\n")
+        with open(os.path.join(self.src.name, "pholder", "phile"), "w") as f:
+            f.write("contents\n")
+        st = os.stat(os.path.join(self.src.name, "pholder", "phile"))
+        syncdir.MasterSession(self.src.name, self.dst.name, out=None, chooser=None, do_everything=True, tracer=self.tracer).run()
+        self.tracer.finish()
+        events = self.events()
+        self.assertEqual(events[0], {"event": "entry", "path": "pholder", "class": "common directory", "a": events[0]["a"], "b": events[0]["b"]})
+        self.assertTrue(stat.S_ISDIR(events[0]["a"][0]))
+        self.assertEqual(events[1], {"event": "entry", "path": os.path.join("pholder", "phile"), "class": "is new", "treatment": "create", "a": [st.st_mode, 9, st.st_mtime_ns]})
+        self.assertEqual(events[2], {"event": "message", "text": os.path.join("pholder", "phile") + " is new, create"})
+        self.assertEqual(events[3], {"event": "action", "path": os.path.join("pholder", "phile"), "treatment": "create", "granted": True, "done": True})
+        self.assertEqual(events[4], {"event": "skip", "path": "thing", "reason": "is directory in source and file in target!"})
+        self.assertEqual(events[5], {"event": "stats", "entries": 3, "errors": 0, "done": {"create": 1}})
+        self.assertEqual(len(events), 6)
+
+class EventTracerTestCase_queued(EventTracerTestCase):
+    def runTest(self):
+        # copies made after the entry is done with are reported as they end
+        class FailingVerifier(syncdir.Verifier):
+            def check(verifier, pathB, hasher, tracer):
+                if os.path.basename(pathB) == "bad phile":
+                    tracer.error(pathB + ": copy differs from source")
+                    return False
+                return syncdir.Verifier.check(verifier, pathB, hasher, tracer)
+        for name in "bad phile", "good phile":
+            with open(os.path.join(self.src.name, name), "w") as f:
+                f.write("contents\n")
+        for fan_out, workers in (False, 2), (True, 1), (True, 2):
+            with self.subTest(fan_out=fan_out, workers=workers):
+                self.out.seek(0)
+                self.out.truncate()
+                self.tracer = syncdir.EventTracer(self.out)
+                dst = tempfile.TemporaryDirectory(prefix="test_syncdir_", suffix=".rhs")
+                self.addCleanup(dst.cleanup)
+                if fan_out:
+                    session = syncdir.FanOutSession(self.src.name, [dst.name], out=None, chooser=None, do_everything=True, tracer=self.tracer, verifier=FailingVerifier(), workers=workers)
+                else:
+                    session = syncdir.MasterSession(self.src.name, dst.name, out=None, chooser=None, do_everything=True, tracer=self.tracer, verifier=FailingVerifier(), workers=workers)
+                session.run()
+                self.tracer.finish()
+                events = self.events()
+                self.assertEqual(sorted((event["path"], event["done"]) for event in events if event["event"] == "action"), [("bad phile", False), ("good phile", True)])
+                self.assertEqual(events[-1], {"event": "stats", "entries": 2, "errors": 1, "done": {"create": 1}})
+
+class EventTracerTestCase_progress(EventTracerTestCase):
+    def runTest(self):
+        self.tracer.PROGRESS_NS = 0
+        self.tracer.trace("busy")
+        self.tracer.error("oops")
+        self.tracer.trace("busy")
+        self.tracer.leave()
+        self.assertEqual(self.events(), [
+            {"event": "progress", "entries": 0, "errors": 0},
+            {"event": "error", "text": "oops"},
+            {"event": "progress", "entries": 0, "errors": 1}])
+
+if __name__ == '__main__':
+    unittest.main()
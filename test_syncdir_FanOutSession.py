@@ -0,0 +1,71 @@
+import io
+import os
+import syncdir
+import tempfile
+import unittest
+
+class FanOutSessionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.src = tempfile.TemporaryDirectory(prefix="test_syncdir_", suffix=".lhs")
+        self.dsts = [tempfile.TemporaryDirectory(prefix="test_syncdir_", suffix=".rhs%i" % i) for i in range(3)]
+        self.out = io.StringIO()
+        os.mkdir(os.path.join(self.src.name, "pholder"))
+        for philename in "phile 1", os.path.join("pholder", "phile 2"):
+            with open(os.path.join(self.src.name, philename), "w") as f:
+                f.write("left contents\n" * 10000)
+        with open(os.path.join(self.dsts[1].name, "phile 1"), "w") as f:
+            f.write("right contents\n")
+        os.mkdir(os.path.join(self.dsts[2].name, "pholder"))
+    def tearDown(self):
+        for folder in self.dsts + [self.src]:
+            folder.cleanup()
+        self.out.close()
+    def runTest(self):
+        opened = []
+        real_open = open
+        def counting_open(path, *args, **kwargs):
+            opened.append((path,) + args)
+            return real_open(path, *args, **kwargs)
+        syncdir.open = counting_open
+        try:
+            syncdir.FanOutSession(self.src.name, [d.name for d in self.dsts], out=self.out, chooser=None, do_everything=True).run()
+        finally:
+            del syncdir.open
+        for folder in self.dsts:
+            self.assertEqual(sorted(os.listdir(folder.name)), ["phile 1", "pholder"])
+            self.assertEqual(os.listdir(os.path.join(folder.name, "pholder")), ["phile 2"])
+            for philename in "phile 1", os.path.join("pholder", "phile 2"):
+                with open(os.path.join(folder.name, philename), "r") as f:
+                    self.assertEqual(f.read(), "left contents\n" * 10000)
+                self.assertEqual(os.stat(os.path.join(folder.name, philename)).st_mtime_ns, os.stat(os.path.join(self.src.name, philename)).st_mtime_ns)
+        self.assertEqual(len([o for o in opened if o[0] == os.path.join(self.src.name, "pholder", "phile 2")]), 1)
+        self.assertEqual(len([o for o in opened if o[0] == os.path.join(self.src.name, "phile 1")]), 1)
+        self.assertIn(os.path.join(self.dsts[1].name, "phile 1") + " has changed somehow, overwrite\n", self.out.getvalue())
+
+class FanOutSessionTestCase_interrupted(FanOutSessionTestCase):
+    def runTest(self):
+        class Chooser:
+            def ask(chooser, prompt):
+                if "phile 1" in prompt:
+                    return "y"
+                raise KeyboardInterrupt
+        with self.assertRaises(KeyboardInterrupt):
+            syncdir.FanOutSession(self.src.name, [d.name for d in self.dsts], out=self.out, chooser=Chooser()).run()
+        with open(os.path.join(self.dsts[0].name, "phile 1"), "r") as f:
+            self.assertEqual(f.read(), "left contents\n" * 10000)
+
+class FanOutSessionTestCase_bounded(FanOutSessionTestCase):
+    def runTest(self):
+        class SmallPendingCopies(syncdir.PendingCopies):
+            MAXCOPIES = 1
+        syncdir.PendingCopies = SmallPendingCopies
+        try:
+            syncdir.FanOutSession(self.src.name, [d.name for d in self.dsts], out=self.out, chooser=None, do_everything=True).run()
+        finally:
+            syncdir.PendingCopies = SmallPendingCopies.__bases__[0]
+        for folder in self.dsts:
+            with open(os.path.join(folder.name, "pholder", "phile 2"), "r") as f:
+                self.assertEqual(f.read(), "left contents\n" * 10000)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+import io
+import os
+import syncdir
+import tarfile
+import tempfile
+import unittest
+
+class StorageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory(prefix="test_syncdir_")
+        self.src = self.path("src")
+        self.dst = self.path("dst")
+        os.mkdir(self.src)
+        os.mkdir(os.path.join(self.src, "pholder"))
+        self.write(os.path.join(self.src, "phile"), b"contents\n", 1234567890123456789)
+        self.write(os.path.join(self.src, "pholder", "phile"), b"\0binary\n" * 10000, 1234567890000000000)
+        os.symlink("phile", os.path.join(self.src, "link"))
+        self.out = io.StringIO()
+    def tearDown(self):
+        self.dir.cleanup()
+        self.out.close()
+    def path(self, name):
+        return os.path.join(self.dir.name, name)
+    def write(self, path, contents, mtime_ns):
+        with open(path, "wb") as f:
+            f.write(contents)
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+    def sync(self, src, dst, **options):
+        master = syncdir.MasterSession(src, dst, out=self.out, chooser=None, do_everything=True, **options)
+        try:
+            master.run()
+        finally:
+            master.close()
+        self.assertEqual(master.tracer.errors, 0, self.out.getvalue())
+    def assertSameTree(self, dirA, dirB):
+        for dirpath, dirnames, filenames in os.walk(dirA):
+            subdir = os.path.relpath(dirpath, dirA)
+            self.assertEqual(sorted(os.listdir(os.path.join(dirB, subdir))), sorted(dirnames + filenames))
+            for name in filenames:
+                pathA = os.path.join(dirpath, name)
+                pathB = os.path.join(dirB, subdir, name)
+                if os.path.islink(pathA):
+                    self.assertEqual(os.readlink(pathA), os.readlink(pathB))
+                else:
+                    with open(pathA, "rb") as fA, open(pathB, "rb") as fB:
+                        self.assertEqual(fA.read(), fB.read())
+                    self.assertEqual(os.stat(pathA).st_mtime_ns // 1000, os.stat(pathB).st_mtime_ns // 1000)
+
+class StorageTestCase_scandir(StorageTestCase):
+    def runTest(self):
+        entries = syncdir.Storage().scandir(self.src, False)
+        self.assertEqual(sorted(entries), ["link", "phile", "pholder"])
+        self.assertEqual(entries["phile"].st_mtime_ns, 1234567890123456789)
+        self.assertTrue(syncdir.stat.S_ISLNK(entries["link"].st_mode))
+        self.assertTrue(syncdir.stat.S_ISREG(syncdir.Storage().scandir(self.src, True)["link"].st_mode))
+        self.assertEqual(syncdir.Storage().scandir(self.path("nowhere"), False), {})
+
+class StorageTestCase_tar_target(StorageTestCase):
+    def runTest(self):
+        for name in "dst.tar", "dst.tar.gz":
+            with self.subTest(name=name):
+                self.sync(self.src, self.path(name), target=syncdir.TarTarget(self.path(name)))
+                with tarfile.open(self.path(name)) as archive:
+                    self.assertEqual(archive.getnames(), ["link", "phile", "pholder", "pholder/phile"])
+                    self.assertEqual(archive.getmember("link").linkname, "phile")
+                    self.assertEqual(archive.extractfile("phile").read(), b"contents\n")
+                    self.assertAlmostEqual(archive.getmember("phile").mtime, 1234567890.123456789, places=5)
+                    self.assertTrue(archive.getmember("pholder").isdir())
+        with self.assertRaises(FileExistsError):
+            syncdir.TarTarget(self.path("dst.tar"))
+
+class StorageTestCase_tar_subdir(StorageTestCase):
+    def runTest(self):
+        self.sync(self.src, self.path("dst.tar"), commonsubdir="pholder", target=syncdir.TarTarget(self.path("dst.tar")))
+        with tarfile.open(self.path("dst.tar")) as archive:
+            self.assertEqual(archive.getnames(), ["pholder", "pholder/phile"])
+            self.assertTrue(archive.getmember("pholder").isdir())
+        target = syncdir.TarTarget(self.path("new.tar"))
+        with open(os.path.join(self.src, "phile"), "rb") as f:
+            target.write(self.path(os.path.join("new.tar", "phile")), f, os.stat(os.path.join(self.src, "phile")))
+        with self.assertRaises(NotADirectoryError):
+            target.mkdir(self.path(os.path.join("new.tar", "phile", "pholder")))
+        target.close()
+
+class StorageTestCase_tar_source(StorageTestCase):
+    def runTest(self):
+        self.sync(self.src, self.path("src.tar"), target=syncdir.TarTarget(self.path("src.tar")))
+        os.mkdir(self.dst)
+        self.sync(self.path("src.tar"), self.dst, source=syncdir.TarSource(self.path("src.tar")), workers=3)
+        self.assertSameTree(self.src, self.dst)
+        self.write(os.path.join(self.dst, "phile"), b"changed\n", 1234567890123456789)
+        self.out.seek(0)
+        self.out.truncate()
+        self.sync(self.path("src.tar"), self.dst, source=syncdir.TarSource(self.path("src.tar")), trust_time=True)
+        self.assertIn("phile has changed as shown, overwrite\n", self.out.getvalue())
+        self.assertNotIn("create", self.out.getvalue())
+        self.assertSameTree(self.src, self.dst)
+
+class StorageTestCase_tar_compressed_source(StorageTestCase):
+    def runTest(self):
+        # decompressed once, not at every member read out of order
+        self.sync(self.src, self.path("src.tar.xz"), target=syncdir.TarTarget(self.path("src.tar.xz")))
+        source = syncdir.TarSource(self.path("src.tar.xz"))
+        self.assertIsNotNone(source.spool)
+        os.mkdir(self.dst)
+        self.sync(self.path("src.tar.xz"), self.dst, source=source)
+        self.assertTrue(source.spool.closed)
+        self.assertSameTree(self.src, self.dst)
+
+class StorageTestCase_tar_implied_dirs(StorageTestCase):
+    def runTest(self):
+        with tarfile.open(self.path("src.tar"), "w") as archive:
+            archive.add(os.path.join(self.src, "pholder", "phile"), "./a/b/phile")
+            archive.add(os.path.join(self.src, "phile"), "a/B")
+        source = syncdir.TarSource(self.path("src.tar"))
+        self.assertEqual(source.listdir(self.path("src.tar")), ["a"])
+        self.assertEqual(sorted(source.listdir(os.path.join(self.path("src.tar"), "a"))), ["B", "b"])
+        self.assertEqual(source.listdir(os.path.join(self.path("src.tar"), "a", "b")), ["phile"])
+        self.assertTrue(syncdir.stat.S_ISDIR(source.stat(os.path.join(self.path("src.tar"), "a", "b"), False).st_mode))
+        self.assertIsNone(source.stat(os.path.join(self.path("src.tar"), "c"), False))
+        os.mkdir(self.dst)
+        self.sync(self.path("src.tar"), self.dst, source=source)
+        with open(os.path.join(self.dst, "a", "B"), "rb") as f:
+            self.assertEqual(f.read(), b"contents\n")
+        self.assertEqual(os.stat(os.path.join(self.dst, "a", "b", "phile")).st_size, 80000)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import syncdir
+import unittest
+
+NS = 1000000000
+
+class Stat:
+    def __init__(self, st_dev, st_mtime_ns):
+        self.st_dev = st_dev
+        self.st_mtime_ns = st_mtime_ns
+
+class TimeModelTestCase(unittest.TestCase):
+    def setUp(self):
+        self.m = syncdir.TimeModel(tolerance_ns=0)
+
+class TimeModelTestCase_equal_ns(TimeModelTestCase):
+    def runTest(self):
+        self.assertTrue(self.m.equal(Stat(1, 1234567890123456789), Stat(2, 1234567890123456789)))
+        self.assertFalse(self.m.equal(Stat(1, 1234567890123456789), Stat(2, 1234567890123456788)))
+
+class TimeModelTestCase_granularity(TimeModelTestCase):
+    def runTest(self):
+        self.assertEqual(self.m.getGranularity(Stat(1, 1234567890 * NS)), NS)
+        self.assertEqual(self.m.getGranularity(Stat(1, 1234567891 * NS)), NS)
+        self.assertEqual(self.m.getGranularity(Stat(1, 1234567890 * NS + 100)), 100)
+        self.assertEqual(self.m.getGranularity(Stat(1, 1234567890 * NS)), NS)
+        self.assertEqual(self.m.getGranularity(Stat(2, 1234567890 * NS + 1)), 1)
+
+class TimeModelTestCase_order(TimeModelTestCase):
+    def runTest(self):
+        # a change 2 seconds later is one, whatever was seen first
+        a = Stat(1, 1234567890 * NS)
+        b = Stat(1, 1234567892 * NS)
+        m = syncdir.TimeModel()
+        self.assertFalse(m.equal(a, b))
+        m.equal(Stat(1, 1234567890 * NS + 1), Stat(1, 1234567890 * NS + 1))
+        self.assertFalse(m.equal(a, b))
+
+class TimeModelTestCase_fat(TimeModelTestCase):
+    def runTest(self):
+        m = syncdir.TimeModel(tolerance_ns=0, fat=True)
+        self.assertEqual(m.getGranularity(Stat(1, 1234567890 * NS)), 2 * NS)
+        self.assertEqual(m.getGranularity(Stat(1, 1234567891 * NS)), NS)
+        self.assertTrue(m.equal(Stat(1, 1234567890 * NS + 1), Stat(2, 1234567892 * NS)))
+        self.assertFalse(m.equal(Stat(1, 1234567890 * NS + 1), Stat(2, 1234567894 * NS)))
+        self.assertFalse(self.m.equal(Stat(1, 1234567890 * NS + 1), Stat(2, 1234567892 * NS)))
+
+class TimeModelTestCase_offsets(TimeModelTestCase):
+    def runTest(self):
+        a = Stat(1, 1234567890 * NS + 1)
+        self.assertTrue(self.m.equal(a, Stat(1, a.st_mtime_ns + 3600 * NS)))
+        self.assertTrue(self.m.equal(a, Stat(1, a.st_mtime_ns - 7200 * NS)))
+        self.assertFalse(self.m.equal(a, Stat(1, a.st_mtime_ns + 1800 * NS)))
+        self.assertFalse(syncdir.TimeModel(tolerance_ns=0, offsets_ns=(0,)).equal(a, Stat(1, a.st_mtime_ns + 3600 * NS)))
+
+class TimeModelTestCase_tolerance(TimeModelTestCase):
+    def runTest(self):
+        m = syncdir.TimeModel(tolerance_ns=NS // 2)
+        a = Stat(1, 1234567890 * NS + 1)
+        self.assertTrue(m.equal(a, Stat(1, a.st_mtime_ns + NS // 2)))
+        self.assertFalse(m.equal(a, Stat(1, a.st_mtime_ns + NS)))
+        self.assertTrue(syncdir.TimeModel().equal(a, Stat(1, a.st_mtime_ns + NS)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import hashlib
+import io
+import os
+import syncdir
+import tempfile
+import unittest
+
+class SmallTreeHasher(syncdir.TreeHasher):
+    CHUNKSIZE = 0x1000
+
+class TreeHasherTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory(prefix="test_syncdir_")
+        self.contents = bytes(range(256)) * 100
+        self.hasher = SmallTreeHasher(workers=3)
+    def tearDown(self):
+        self.dir.cleanup()
+    def write(self, name, contents):
+        path = os.path.join(self.dir.name, name)
+        with open(path, "wb") as f:
+            f.write(contents)
+        return path
+
+class TreeHasherTestCase_digest(TreeHasherTestCase):
+    def runTest(self):
+        path = self.write("phile", self.contents)
+        chunks = [self.contents[i:i + 0x1000] for i in range(0, len(self.contents), 0x1000)]
+        root = hashlib.blake2b(fanout=0, depth=2, leaf_size=0x1000, inner_size=64, node_offset=0, node_depth=1, last_node=True)
+        for index, chunk in enumerate(chunks):
+            root.update(hashlib.blake2b(chunk, fanout=0, depth=2, leaf_size=0x1000, inner_size=64, node_offset=index, node_depth=0, last_node=index == len(chunks) - 1).digest())
+        self.assertEqual(self.hasher.digest(path), root.hexdigest())
+        self.assertEqual(SmallTreeHasher(workers=1).digest(path), root.hexdigest())
+        self.assertNotEqual(self.hasher.digest(self.write("other", self.contents[:-1])), root.hexdigest())
+
+class TreeHasherTestCase_equal(TreeHasherTestCase):
+    def runTest(self):
+        pathA = self.write("phile A", self.contents)
+        self.assertTrue(self.hasher.equal(pathA, self.write("phile B", self.contents)))
+        for offset in 0, 0x1000, len(self.contents) - 1:
+            with self.subTest(offset=offset):
+                changed = bytearray(self.contents)
+                changed[offset] ^= 1
+                self.assertFalse(self.hasher.equal(pathA, self.write("phile B", changed)))
+
+class TreeHasherTestCase_session(TreeHasherTestCase):
+    def runTest(self):
+        # files larger than a chunk are compared by the tree hasher
+        contents = self.contents * 4
+        compared = []
+        class CountingTreeHasher(SmallTreeHasher):
+            def equal(self, pathA, pathB):
+                compared.append(os.path.basename(pathA))
+                return SmallTreeHasher.equal(self, pathA, pathB)
+        changed = bytearray(contents)
+        changed[-1] ^= 1
+        os.mkdir(os.path.join(self.dir.name, "src"))
+        os.mkdir(os.path.join(self.dir.name, "dst"))
+        for name, contentsA, contentsB in ("equal", contents, contents), ("different", contents, changed):
+            pathA = self.write(os.path.join("src", name), contentsA)
+            pathB = self.write(os.path.join("dst", name), contentsB)
+            os.utime(pathB, ns=(10**18, 10**18))
+        out = io.StringIO()
+        master = syncdir.MasterSession(os.path.join(self.dir.name, "src"), os.path.join(self.dir.name, "dst"), out=out, chooser=None, do_everything=True, workers=3)
+        self.assertIsNotNone(master.tree_hasher)
+        master.tree_hasher.executor.shutdown()
+        master.tree_hasher = hasher = CountingTreeHasher(workers=3)
+        try:
+            master.run()
+        finally:
+            master.close()
+        self.assertEqual(sorted(compared), ["different", "equal"])
+        self.assertIn("equal has different time, touch\n", out.getvalue())
+        for name in "equal", "different":
+            with open(os.path.join(self.dir.name, "dst", name), "rb") as f:
+                self.assertEqual(f.read(), contents)
+        self.assertRaises(RuntimeError, hasher.executor.submit, int)
+
+if __name__ == '__main__':
+    unittest.main()
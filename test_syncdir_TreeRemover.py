@@ -0,0 +1,81 @@
+import io
+import os
+import syncdir
+import tempfile
+import unittest
+
+class TreeRemoverTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory(prefix="test_syncdir_")
+        self.outside = tempfile.TemporaryDirectory(prefix="test_syncdir_")
+        self.out = io.StringIO()
+        self.tracer = syncdir.Tracer(self.out)
+        with open(os.path.join(self.outside.name, "phile"), "w") as f:
+            f.write("outside\n")
+    def tearDown(self):
+        self.outside.cleanup()
+        self.dir.cleanup()
+        self.out.close()
+    def makeTree(self, root, depth):
+        os.mkdir(root)
+        for i in range(3):
+            with open(os.path.join(root, "phile %i" % i), "w") as f:
+                f.write("contents\n")
+        os.symlink(self.outside.name, os.path.join(root, "link"))
+        if depth:
+            for i in range(3):
+                self.makeTree(os.path.join(root, "pholder %i" % i), depth - 1)
+
+class TreeRemoverTestCase_remove(TreeRemoverTestCase):
+    def runTest(self):
+        for workers in 1, 4:
+            with self.subTest(workers=workers):
+                root = os.path.join(self.dir.name, "tree")
+                self.makeTree(root, 3)
+                self.assertTrue(syncdir.TreeRemover(workers).remove(root, self.tracer))
+                self.assertEqual(os.listdir(self.dir.name), [])
+                self.assertEqual(os.listdir(self.outside.name), ["phile"])
+                self.assertEqual(self.tracer.errors, 0)
+
+class TreeRemoverTestCase_missing(TreeRemoverTestCase):
+    def runTest(self):
+        root = os.path.join(self.dir.name, "tree")
+        self.assertFalse(syncdir.TreeRemover(2).remove(root, self.tracer))
+        self.assertEqual(self.out.getvalue(), root + ": No such file or directory\n")
+        self.assertEqual(self.tracer.errors, 1)
+
+class TreeRemoverTestCase_session(TreeRemoverTestCase):
+    def runTest(self):
+        src = os.path.join(self.dir.name, "src")
+        dst = os.path.join(self.dir.name, "dst")
+        os.mkdir(src)
+        os.mkdir(dst)
+        self.makeTree(os.path.join(dst, "pholder"), 2)
+        syncdir.MasterSession(src, dst, out=self.out, chooser=None, do_everything=True, workers=3).run()
+        self.assertEqual(self.out.getvalue(), "pholder has disappeared, descend & remove\n")
+        self.assertEqual(os.listdir(dst), [])
+
+class TreeRemoverTestCase_swapped(TreeRemoverTestCase):
+    def runTest(self):
+        # a directory replaced by a link to elsewhere while its
+        # subdirectories are being removed
+        outside = self.outside.name
+        os.mkdir(os.path.join(outside, "pholder 0"))
+        with open(os.path.join(outside, "pholder 0", "phile 0"), "w") as f:
+            f.write("outside\n")
+        class SwappingTreeRemover(syncdir.TreeRemover):
+            swapped = False
+            def removeDir(remover, parent, name, path):
+                if parent is not None and parent.parent is not None and not remover.swapped:
+                    remover.swapped = True
+                    os.rename(parent.path, parent.path + " moved")
+                    os.symlink(outside, parent.path)
+                syncdir.TreeRemover.removeDir(remover, parent, name, path)
+        root = os.path.join(self.dir.name, "tree")
+        self.makeTree(root, 2)
+        self.assertFalse(SwappingTreeRemover(1).remove(root, self.tracer))
+        self.assertEqual(sorted(os.listdir(outside)), ["phile", "pholder 0"])
+        self.assertEqual(os.listdir(os.path.join(outside, "pholder 0")), ["phile 0"])
+
+if __name__ == '__main__':
+    unittest.main()
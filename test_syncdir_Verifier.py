@@ -0,0 +1,63 @@
+import hashlib
+import io
+import os
+import syncdir
+import tempfile
+import unittest
+
+class VerifierTestCase(unittest.TestCase):
+    def setUp(self):
+        self.src = tempfile.TemporaryDirectory(prefix="test_syncdir_", suffix=".lhs")
+        self.dst = tempfile.TemporaryDirectory(prefix="test_syncdir_", suffix=".rhs")
+        self.out = io.StringIO()
+        self.manifest = io.StringIO()
+        self.contents = b"contents\n" * 100000
+        self.pathA = os.path.join(self.src.name, "phile")
+        self.pathB = os.path.join(self.dst.name, "phile")
+        with open(self.pathA, "wb") as f:
+            f.write(self.contents)
+        self.tracer = syncdir.Tracer(self.out)
+    def tearDown(self):
+        self.dst.cleanup()
+        self.src.cleanup()
+        self.out.close()
+        self.manifest.close()
+
+class VerifierTestCase_copy(VerifierTestCase):
+    def runTest(self):
+        verifier = syncdir.Verifier(manifest=self.manifest)
+        written = syncdir.copy_file(self.pathA, [self.pathB], os.stat(self.pathA), self.tracer, verifier)
+        self.assertEqual(written, [self.pathB])
+        self.assertEqual(self.out.getvalue(), "")
+        self.assertEqual(self.manifest.getvalue(), "%s  %s\n" % (hashlib.sha256(self.contents).hexdigest(), self.pathB))
+        with open(self.pathB, "rb") as f:
+            self.assertEqual(f.read(), self.contents)
+        self.assertEqual(os.stat(self.pathB).st_mtime_ns, os.stat(self.pathA).st_mtime_ns)
+
+class VerifierTestCase_mismatch(VerifierTestCase):
+    def runTest(self):
+        verifier = syncdir.Verifier(manifest=self.manifest)
+        with open(self.pathB, "wb") as f:
+            f.write(self.contents[1:])
+        self.assertFalse(verifier.check(self.pathB, hashlib.sha256(self.contents), self.tracer))
+        self.assertEqual(self.out.getvalue(), self.pathB + ": copy differs from source\n")
+        self.assertEqual(self.manifest.getvalue(), "")
+
+class VerifierTestCase_corrupted(VerifierTestCase):
+    def runTest(self):
+        class CorruptingVerifier(syncdir.Verifier):
+            def release(verifier, fileB):
+                syncdir.Verifier.release(verifier, fileB)
+                fileB.seek(0)
+                fileB.write(b"C")
+                fileB.flush()
+        os.utime(self.pathA, ns=(1000000000000000000, 1000000000000000000))
+        syncdir.MasterSession(self.src.name, self.dst.name, out=self.out, chooser=None, do_everything=True, verifier=CorruptingVerifier()).run()
+        self.assertIn(self.pathB + ": copy differs from source\n", self.out.getvalue())
+        self.assertNotEqual(os.stat(self.pathB).st_mtime_ns, os.stat(self.pathA).st_mtime_ns)
+        syncdir.MasterSession(self.src.name, self.dst.name, out=self.out, chooser=None, do_everything=True).run()
+        with open(self.pathB, "rb") as f:
+            self.assertEqual(f.read(), self.contents)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import errno
+import io
+import os
+import syncdir
+import tempfile
+import unittest
+
+class BatchTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory(prefix="test_syncdir_")
+        self.out = io.StringIO()
+        for i in range(3):
+            os.mkdir(self.path("src%i" % i))
+            os.mkdir(self.path("dst%i" % i))
+            with open(self.path("src%i" % i, "phile"), "w") as f:
+                f.write("contents %i\n" % i)
+        with open(self.path("jobs"), "w") as f:
+            f.write("# comment\n")
+            f.write("-y '%s' '%s'\n" % (self.path("src0"), self.path("dst0")))
+            f.write("\n")
+            f.write("-n '%s' '%s'\n" % (self.path("src1"), self.path("dst1")))
+            f.write("'%s' '%s'\n" % (self.path("src2"), self.path("dst2")))
+            f.write("-y '%s' '%s'\n" % (self.path("src2"), self.path("nowhere")))
+    def tearDown(self):
+        self.dir.cleanup()
+        self.out.close()
+    def path(self, *names):
+        return os.path.join(self.dir.name, *names)
+    def runBatch(self, *argv):
+        options, args = syncdir.make_parser().parse_args(["-b", self.path("jobs")] + list(argv))
+        return syncdir.run_batch(options, self.out)
+
+class BatchTestCase_concurrent(BatchTestCase):
+    def runTest(self):
+        self.assertEqual(self.runBatch("-j", "3"), 1)
+        out = self.out.getvalue().split("\n")
+        self.assertEqual(out[0], "phile is new, create")
+        self.assertEqual(out[1], "phile is new, create")
+        self.assertEqual(out[2], "'%s' '%s': Can't ask questions while running several jobs" % (self.path("src2"), self.path("dst2")))
+        self.assertEqual(out[3], "-y '%s' '%s': 2 paths to directories needed" % (self.path("src2"), self.path("nowhere")))
+        self.assertEqual(out[4], "4 jobs, 2 failed")
+        self.assertEqual(os.listdir(self.path("dst0")), ["phile"])
+        self.assertEqual(os.listdir(self.path("dst1")), [])
+        self.assertEqual(os.listdir(self.path("dst2")), [])
+
+class BatchTestCase_defaults(BatchTestCase):
+    def runTest(self):
+        self.assertEqual(self.runBatch("-j", "2", "-y"), 1)
+        self.assertTrue(self.out.getvalue().endswith("4 jobs, 1 failed\nfailed: -y '%s' '%s'\n" % (self.path("src2"), self.path("nowhere"))))
+        self.assertEqual(os.listdir(self.path("dst0")), ["phile"])
+        self.assertEqual(os.listdir(self.path("dst1")), [])
+        self.assertEqual(os.listdir(self.path("dst2")), ["phile"])
+
+class BatchTestCase_more_destinations(BatchTestCase):
+    def runTest(self):
+        os.mkdir(self.path("more"))
+        with open(self.path("jobs"), "w") as f:
+            f.write("-y -d '%s' '%s' '%s'\n" % (self.path("more"), self.path("src0"), self.path("dst0")))
+            f.write("-y '%s' '%s'\n" % (self.path("src1"), self.path("dst1")))
+        self.assertEqual(self.runBatch(), 0)
+        self.assertEqual(os.listdir(self.path("more")), ["phile"])
+        with open(self.path("more", "phile")) as f:
+            self.assertEqual(f.read(), "contents 0\n")
+        self.assertEqual(os.listdir(self.path("dst1")), ["phile"])
+
+class BatchTestCase_cancelled(BatchTestCase):
+    def runTest(self):
+        real_run = syncdir.MasterSession.run
+        def run(master):
+            if master.dirA == self.path("src1"):
+                raise KeyboardInterrupt
+            real_run(master)
+        syncdir.MasterSession.run = run
+        try:
+            self.assertEqual(self.runBatch("-y"), 1)
+        finally:
+            syncdir.MasterSession.run = real_run
+        self.assertTrue(self.out.getvalue().endswith("cancelled\nbatch cancelled\n4 jobs, 1 failed, 2 not run\nfailed: -n '%s' '%s'\n" % (self.path("src1"), self.path("dst1"))))
+        self.assertEqual(os.listdir(self.path("dst0")), ["phile"])
+        self.assertEqual(os.listdir(self.path("dst2")), [])
+
+class BatchTestCase_broken(BatchTestCase):
+    def runTest(self):
+        # a job that breaks down fails without stopping the others
+        real_run = syncdir.MasterSession.run
+        def run(master):
+            if master.dirA == self.path("src1"):
+                raise OSError(errno.EROFS, os.strerror(errno.EROFS), master.dirB)
+            real_run(master)
+        syncdir.MasterSession.run = run
+        self.addCleanup(setattr, syncdir.MasterSession, "run", real_run)
+        for jobs in 1, 3:
+            with self.subTest(jobs=jobs):
+                self.out.seek(0)
+                self.out.truncate()
+                self.assertEqual(self.runBatch("-y", "-j", str(jobs)), 1)
+                self.assertIn("-n '%s' '%s': [Errno %i] %s: '%s'\n" % (self.path("src1"), self.path("dst1"), errno.EROFS, os.strerror(errno.EROFS), self.path("dst1")), self.out.getvalue())
+                self.assertTrue(self.out.getvalue().endswith("4 jobs, 2 failed\nfailed: -n '%s' '%s'\nfailed: -y '%s' '%s'\n" % (self.path("src1"), self.path("dst1"), self.path("src2"), self.path("nowhere"))), self.out.getvalue())
+                self.assertEqual(os.listdir(self.path("dst2")), ["phile"])
+
+if __name__ == '__main__':
+    unittest.main()
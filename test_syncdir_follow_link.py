@@ -0,0 +1,59 @@
+import io
+import os
+import syncdir
+import tempfile
+import unittest
+
+class FollowLinkTestCase(unittest.TestCase):
+    def setUp(self):
+        self.src = tempfile.TemporaryDirectory(prefix="test_syncdir_", suffix=".lhs")
+        self.dst = tempfile.TemporaryDirectory(prefix="test_syncdir_", suffix=".rhs")
+        self.out = io.StringIO()
+    def tearDown(self):
+        self.dst.cleanup()
+        self.src.cleanup()
+        self.out.close()
+    def makeTree(self, root):
+        os.mkdir(os.path.join(root, "pholder"))
+        with open(os.path.join(root, "pholder", "phile"), "w") as f:
+            f.write("contents\n")
+        os.symlink("..", os.path.join(root, "pholder", "loop"))
+    def run_master(self):
+        syncdir.MasterSession(self.src.name, self.dst.name, out=self.out, chooser=None, do_everything=True, follow_link=True).run()
+
+class FollowLinkTestCase_loop(FollowLinkTestCase):
+    def runTest(self):
+        self.makeTree(self.src.name)
+        os.symlink("pholder", os.path.join(self.src.name, "alias"))
+        self.run_master()
+        self.assertEqual(sorted(os.listdir(self.dst.name)), ["alias", "pholder"])
+        for subdir in "alias", "pholder":
+            self.assertEqual(os.listdir(os.path.join(self.dst.name, subdir)), ["phile"])
+        out = self.out.getvalue().split("\n")
+        self.assertIn(os.path.join("alias", "loop") + " skipped - is a link to a directory containing it", out)
+        self.assertIn(os.path.join("pholder", "loop") + " skipped - is a link to a directory containing it", out)
+
+class FollowLinkTestCase_visited(FollowLinkTestCase):
+    def runTest(self):
+        for folder in self.src, self.dst:
+            self.makeTree(folder.name)
+            os.symlink("pholder", os.path.join(folder.name, "alias"))
+        self.run_master()
+        self.assertEqual(self.out.getvalue().split("\n"), [
+            os.path.join("alias", "loop") + " skipped - is a link to a directory containing it",
+            "\r" + os.path.join("alias", "phile") + " has not changed\r                           \rpholder skipped - was compared as alias",
+            ""])
+
+class FollowLinkTestCase_remove_link(FollowLinkTestCase):
+    def runTest(self):
+        self.makeTree(self.dst.name)
+        os.symlink(self.src.name, os.path.join(self.dst.name, "pholder", "elsewhere"))
+        with open(os.path.join(self.src.name, "keep"), "w") as f:
+            f.write("contents\n")
+        syncdir.MasterSession(self.src.name, os.path.join(self.dst.name, "pholder"), out=self.out, chooser=None, do_everything=True, follow_link=True, ignore_time=True).run()
+        self.assertEqual(os.listdir(self.src.name), ["keep"])
+        self.assertEqual(os.listdir(os.path.join(self.dst.name, "pholder")), ["keep"])
+        self.assertEqual(os.listdir(self.dst.name), ["pholder"])
+
+if __name__ == '__main__':
+    unittest.main()
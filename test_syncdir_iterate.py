@@ -0,0 +1,89 @@
+import asyncio
+import os
+import syncdir
+import tempfile
+import time
+import unittest
+
+class IterateTestCase(unittest.TestCase):
+    def setUp(self):
+        self.src = tempfile.TemporaryDirectory(prefix="test_syncdir_", suffix=".lhs")
+        self.dst = tempfile.TemporaryDirectory(prefix="test_syncdir_", suffix=".rhs")
+        for folder in self.src, self.dst:
+            os.mkdir(os.path.join(folder.name, "pholder"))
+        with open(os.path.join(self.src.name, "pholder", "new phile"), "w") as f:
+            f.write("contents\n")
+        with open(os.path.join(self.dst.name, "old phile"), "w") as f:
+            f.write("contents\n")
+        self.asked = []
+    def tearDown(self):
+        self.dst.cleanup()
+        self.src.cleanup()
+    def decide(self, outcome):
+        self.assertEqual(outcome.kind, 'ask')
+        self.asked.append(outcome.subject)
+        return outcome.action.reason == "is new"
+    def check(self, outcomes):
+        self.assertEqual([(o.kind, o.subject, o.granted, o.done) for o in outcomes], [
+            ('action', "old phile", False, False),
+            ('entry', "pholder", None, None),
+            ('action', os.path.join("pholder", "new phile"), True, True)])
+        self.assertIsNone(outcomes[0].statA)
+        self.assertEqual(outcomes[0].statB.st_size, 9)
+        self.assertEqual(outcomes[2].statA.st_size, 9)
+        self.assertIsNone(outcomes[2].statB)
+        self.assertEqual(self.asked, ["old phile", os.path.join("pholder", "new phile")])
+        self.assertEqual(os.listdir(os.path.join(self.dst.name, "pholder")), ["new phile"])
+        self.assertEqual(sorted(os.listdir(self.dst.name)), ["old phile", "pholder"])
+
+class IterateTestCase_sync(IterateTestCase):
+    def runTest(self):
+        self.check(list(syncdir.iterate(self.src.name, self.dst.name, decide=self.decide)))
+
+class IterateTestCase_close(IterateTestCase):
+    def runTest(self):
+        for i in range(100):
+            with open(os.path.join(self.src.name, "phile %02i" % i), "w") as f:
+                f.write("contents\n")
+        outcomes = syncdir.iterate(self.src.name, self.dst.name, backlog=1, do_everything=True)
+        self.assertEqual(next(outcomes).subject, "old phile")
+        outcomes.close()
+        copied = os.listdir(self.dst.name)
+        self.assertNotIn("old phile", copied)
+        self.assertLess(len(copied), 10)
+        time.sleep(0.2)
+        self.assertEqual(os.listdir(self.dst.name), copied)
+
+class IterateTestCase_queued(IterateTestCase):
+    def runTest(self):
+        # a copy is reported done once it's there, timestamp included
+        for i in range(20):
+            with open(os.path.join(self.src.name, "phile %02i" % i), "wb") as f:
+                f.write(bytes(range(256)) * 20 + bytes([i % 2]))
+        outcomes = 0
+        for outcome in syncdir.iterate(self.src.name, self.dst.name, do_everything=True, workers=3, dedup="link"):
+            if outcome.kind == 'action' and outcome.action.treatment == "create":
+                self.assertTrue(outcome.done)
+                pathA = os.path.join(self.src.name, outcome.subject)
+                pathB = os.path.join(self.dst.name, outcome.subject)
+                self.assertEqual(os.stat(pathB).st_mtime_ns, os.stat(pathA).st_mtime_ns)
+                outcomes += 1
+        self.assertEqual(outcomes, 21)
+
+class IterateTestCase_async(IterateTestCase):
+    def runTest(self):
+        async def decide(outcome):
+            await asyncio.sleep(0)
+            return self.decide(outcome)
+        async def collect():
+            return [outcome async for outcome in syncdir.iterate_async(self.src.name, self.dst.name, decide=decide)]
+        self.check(asyncio.run(collect()))
+
+class IterateTestCase_quit(IterateTestCase):
+    def runTest(self):
+        outcomes = list(syncdir.iterate(self.src.name, self.dst.name, decide=lambda outcome: 'Q'))
+        self.assertEqual(outcomes, [])
+        self.assertEqual(os.listdir(os.path.join(self.dst.name, "pholder")), [])
+
+if __name__ == '__main__':
+    unittest.main()